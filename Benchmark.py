@@ -0,0 +1,314 @@
+""" Benchmark which plays seeded headless games and reports how well and how quickly the heuristic plays. Run with
+python3 -m Benchmark, results are written as JSON so runs can be compared across commits """
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import Board
+import Constants
+import Engine
+import Game
+import Metrics
+import Tetrominoes
+import Tuner
+
+# The directory holding the game's modules and entry points
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# Run in a new process with the path of an entry point, which is run as it is on the wall until its first frame is
+# presented. Prints the time the entry point began, the time its imports and setup ended, marked by the gc.freeze every
+# entry point calls before playing, and the time the first frame was presented, in seconds since the epoch
+STARTUP_SCRIPT = """
+import time
+import_start = time.time()
+import gc
+import os
+import runpy
+import sys
+import Display
+freeze = gc.freeze
+present = Display.present
+import_end = None
+
+
+def mark_import_end():
+    global import_end
+    import_end = time.time()
+    freeze()
+
+
+def present_first_frame(current_time):
+    present(current_time)
+    print(import_start, import_end, time.time(), flush=True)
+    os._exit(0)
+
+
+gc.freeze = mark_import_end
+Display.present = present_first_frame
+runpy.run_path(sys.argv[1], run_name="__main__")
+"""
+
+
+def percentile(values, fraction):
+    """ Returns the value at the given fraction of the sorted values using the nearest rank """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def get_commit():
+    """ Returns the hash of the checked out commit, or None if it can't be found """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=SOURCE_DIRECTORY).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def play_game(engine, seed, max_ticks):
+    """ Plays a single seeded game and returns its results """
+    engine.reset(seed)
+    start_time = time.perf_counter()
+    engine.run(max_ticks)
+    wall_time = time.perf_counter() - start_time
+    latencies = engine.decision_latencies
+    return {
+        "seed": seed,
+        "cleared_lines": Game.cleared_lines,
+        "placed_tetrominoes": Game.placed_tetrominoes,
+        "ticks": engine.ticks,
+        "game_over": Game.game_over,
+        "decisions": len(latencies),
+        "decision_time": engine.decision_time,
+        "wall_time": wall_time,
+        "latencies": latencies,
+    }
+
+
+def summarise(games):
+    """ Combines the results of every game into a single summary """
+    latencies = [latency for game in games for latency in game["latencies"]]
+    decision_time = sum(game["decision_time"] for game in games)
+    return {
+        "games": len(games),
+        "cleared_lines": sum(game["cleared_lines"] for game in games),
+        "placed_tetrominoes": sum(game["placed_tetrominoes"] for game in games),
+        "decisions_per_second": len(latencies) / decision_time if decision_time else 0,
+        "p50_decision_latency_ms": percentile(latencies, 0.5) * 1000,
+        "p99_decision_latency_ms": percentile(latencies, 0.99) * 1000,
+        "wall_time": sum(game["wall_time"] for game in games),
+        "tick_time_ms": sum(game["wall_time"] for game in games) / max(sum(game["ticks"] for game in games), 1) * 1000,
+    }
+
+
+def run_benchmark(game_count, seed, max_ticks):
+    """ Plays game_count games seeded from seed onwards and returns the results """
+    engine = Engine.Engine()
+    games = [play_game(engine, seed + game, max_ticks) for game in range(game_count)]
+    summary = summarise(games)
+    for game in games:
+        del game["latencies"]
+    return {
+        "commit": get_commit(),
+        "config": {
+            "board_width": Constants.BOARD_WIDTH,
+            "board_height": Constants.BOARD_HEIGHT,
+            "num_games": Constants.NUM_GAMES,
+            "scoring_backend": Constants.SCORING_BACKEND,
+            "heuristic_processes": Constants.HEURISTIC_PROCESSES,
+            "lookahead_depth": Constants.LOOKAHEAD_DEPTH,
+            "factors": Tuner.get_factors(),
+            "seed": seed,
+            "max_ticks": max_ticks,
+        },
+        "summary": summary,
+        "games": games,
+    }
+
+
+def run_width_benchmark(widths, arguments):
+    """ Runs the benchmark with the given arguments on walls of each width, scaling the number of games with the width.
+    As the board dimensions are read when the game modules are imported, each width is benchmarked in a new process with
+    the panels overridden through the environment. Returns the results for each width """
+    results = {}
+    for width in widths:
+        if width % Constants.PANEL_WIDTH:
+            raise ValueError(f"A width of {width} columns isn't a whole number of {Constants.PANEL_WIDTH} column panels")
+        environment = dict(os.environ)
+        environment["TETRIS_PANELS_ACROSS"] = str(width // Constants.PANEL_WIDTH)
+        environment["TETRIS_NUM_GAMES"] = str(max(Constants.NUM_GAMES * width // Constants.BOARD_WIDTH, 1))
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "benchmark.json")
+            subprocess.run([sys.executable, "-m", "Benchmark", *arguments, "--output", output], env=environment,
+                           check=True, stdout=subprocess.DEVNULL)
+            with open(output) as benchmark:
+                results[width] = json.load(benchmark)
+    return results
+
+
+def measure_startup(runs, entry="Game.py"):
+    """ Starts the game from the entry point in runs new processes and measures the time from starting each process to
+    presenting its first frame on the DISPLAY_BACKEND sink. Returns the median times in milliseconds to start the
+    interpreter, import and set up the game and create the sink and present the first frame """
+    interpreter_times = []
+    import_times = []
+    first_frame_times = []
+    for _ in range(runs):
+        start_time = time.time()
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, os.path.join(SOURCE_DIRECTORY, entry)],
+                                stdin=subprocess.DEVNULL, capture_output=True, text=True, check=True,
+                                cwd=SOURCE_DIRECTORY).stdout
+        import_start, import_end, frame_time = (float(value) for value in output.split()[-3:])
+        interpreter_times.append(import_start - start_time)
+        import_times.append(import_end - import_start)
+        first_frame_times.append(frame_time - import_end)
+    return {
+        "runs": runs,
+        "entry": entry,
+        "display_backend": Constants.DISPLAY_BACKEND,
+        "interpreter_ms": percentile(interpreter_times, 0.5) * 1000,
+        "import_ms": percentile(import_times, 0.5) * 1000,
+        "first_frame_ms": percentile(first_frame_times, 0.5) * 1000,
+        "time_to_first_frame_ms": percentile([interpreter + imports + frame for interpreter, imports, frame in
+                                              zip(interpreter_times, import_times, first_frame_times)], 0.5) * 1000,
+    }
+
+
+def row_by_row_collides(tetromino, board):
+    """ The collision check before Board.collides, kept to compare against. Indexes the board for each row of the
+    tetromino's rotation """
+    for row, mask in enumerate(tetromino.orientation.masks[tetromino.xpos]):
+        if mask & board[tetromino.ypos + row]:
+            return True
+    return False
+
+
+def row_by_row_drop_distance(tetromino, board):
+    """ Finds how far the tetromino can drop by checking each row below it in turn, kept to compare against
+    Board.drop_distance """
+    distance = 0
+    while tetromino.ypos + distance + tetromino.height < Constants.BOARD_HEIGHT:
+        tetromino.ypos += distance + 1
+        collides = row_by_row_collides(tetromino, board)
+        tetromino.ypos -= distance + 1
+        if collides:
+            break
+        distance += 1
+    return distance
+
+
+def measure_collisions(count, seed):
+    """ Times collision checks and drop distances for count random tetromino positions over a board with its lower
+    half randomly filled, comparing the row by row functions with those in Board. Returns the mean times in
+    nanoseconds """
+    generator = random.Random(seed)
+    board = [0] * Constants.BOARD_HEIGHT
+    for row in range(Constants.BOARD_HEIGHT // 2, Constants.BOARD_HEIGHT):
+        board[row] = generator.getrandbits(Constants.BOARD_WIDTH) | generator.getrandbits(Constants.BOARD_WIDTH)
+    columns = Board.find_columns(board)
+    tetrominoes = []
+    for _ in range(count):
+        tetromino = Tetrominoes.tetromino_classes[generator.randrange(len(Tetrominoes.tetromino_classes))](0)
+        tetromino.rotation = generator.randrange(len(tetromino.patterns))
+        tetromino.xpos = generator.randrange(Constants.BOARD_WIDTH - tetromino.width + 1)
+        tetromino.ypos = generator.randrange(Constants.BOARD_HEIGHT - tetromino.height + 1)
+        tetrominoes.append(tetromino)
+    # Drop distances are only measured from positions which don't already collide
+    free = [tetromino for tetromino in tetrominoes if not row_by_row_collides(tetromino, board)]
+
+    def time_calls(function, arguments):
+        start_time = time.perf_counter()
+        for argument in arguments:
+            function(*argument)
+        return (time.perf_counter() - start_time) / max(len(arguments), 1) * 1e9
+
+    return {
+        "positions": count,
+        "board_width": Constants.BOARD_WIDTH,
+        "row_by_row_collides_ns": time_calls(row_by_row_collides, [(tetromino, board) for tetromino in tetrominoes]),
+        "collides_ns": time_calls(Board.collides, [(board, tetromino.orientation.masks[tetromino.xpos], tetromino.ypos)
+                                                   for tetromino in tetrominoes]),
+        "row_by_row_drop_distance_ns": time_calls(row_by_row_drop_distance, [(tetromino, board) for tetromino in free]),
+        "drop_distance_ns": time_calls(Board.drop_distance, [(columns, tetromino.orientation, tetromino.xpos,
+                                                              tetromino.ypos) for tetromino in free]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plays seeded headless games and reports heuristic performance")
+    parser.add_argument("--games", type=int, default=5, help="the number of games to play")
+    parser.add_argument("--seed", type=int, default=0, help="the seed of the first game")
+    parser.add_argument("--max-ticks", type=int, default=20000, help="the tick limit for each game")
+    parser.add_argument("--backend", choices=["python", "numpy"], default=Constants.SCORING_BACKEND,
+                        help="the scoring backend to use")
+    parser.add_argument("--profile", default=Constants.HEURISTIC_PROFILE,
+                        help="a profile of heuristic factors written by the tuner")
+    parser.add_argument("--metrics", action="store_true", help="record per stage metrics for the hot paths")
+    parser.add_argument("--widths", type=int, nargs="+",
+                        help="benchmark walls of each of these widths in columns instead of the configured wall")
+    parser.add_argument("--startup", type=int, metavar="RUNS",
+                        help="measure the time to the first frame over this many new processes instead")
+    parser.add_argument("--entry", choices=["Game.py", "Runtime.py"], default="Game.py",
+                        help="the entry point started when measuring the time to the first frame")
+    parser.add_argument("--collisions", type=int, metavar="POSITIONS",
+                        help="time collision checks and drop distances for this many random positions instead")
+    parser.add_argument("--output", default="benchmark.json", help="the file the JSON results are written to")
+    args = parser.parse_args()
+
+    if args.collisions:
+        results = measure_collisions(args.collisions, args.seed)
+        with open(args.output, "w") as output:
+            json.dump({"commit": get_commit(), "collisions": results}, output, indent=2)
+        print(f"Collision check {results['collides_ns']:.0f}ns, row by row {results['row_by_row_collides_ns']:.0f}ns")
+        print(f"Drop distance {results['drop_distance_ns']:.0f}ns, row by row "
+              f"{results['row_by_row_drop_distance_ns']:.0f}ns")
+        return
+
+    if args.startup:
+        results = measure_startup(args.startup, args.entry)
+        with open(args.output, "w") as output:
+            json.dump({"commit": get_commit(), "startup": results}, output, indent=2)
+        print(f"First frame from {results['entry']} on the {results['display_backend']} display after "
+              f"{results['time_to_first_frame_ms']:.1f}ms: interpreter {results['interpreter_ms']:.1f}ms, "
+              f"imports and setup {results['import_ms']:.1f}ms, "
+              f"first frame {results['first_frame_ms']:.1f}ms")
+        return
+
+    if args.widths:
+        arguments = ["--games", str(args.games), "--seed", str(args.seed), "--max-ticks", str(args.max_ticks),
+                     "--backend", args.backend]
+        if args.profile:
+            arguments += ["--profile", args.profile]
+        results = run_width_benchmark(args.widths, arguments)
+        with open(args.output, "w") as output:
+            json.dump({"commit": get_commit(), "widths": results}, output, indent=2)
+        for width, result in results.items():
+            summary = result["summary"]
+            print(f"{width} columns, {result['config']['num_games']} games: {summary['tick_time_ms']:.3f}ms per tick, "
+                  f"p99 decision {summary['p99_decision_latency_ms']:.2f}ms, {summary['cleared_lines']} lines")
+        return
+
+    Constants.SCORING_BACKEND = args.backend
+    if args.profile:
+        Tuner.load_profile(args.profile)
+    if args.metrics:
+        Metrics.install()
+    results = run_benchmark(args.games, args.seed, args.max_ticks)
+    if args.metrics:
+        results["metrics"] = Metrics.report()
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+
+    summary = results["summary"]
+    print(f"Played {summary['games']} games in {summary['wall_time']:.2f}s, {summary['tick_time_ms']:.3f}ms per tick")
+    print(f"Cleared {summary['cleared_lines']} lines placing {summary['placed_tetrominoes']} tetrominoes")
+    print(f"{summary['decisions_per_second']:.1f} decisions per second, "
+          f"p50 {summary['p50_decision_latency_ms']:.2f}ms, p99 {summary['p99_decision_latency_ms']:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+""" Operations shared by every board stored as a list of rows, where each row is a binary number with a bit for each
+column and a 1 indicating the position is occupied. A board may also be indexed by column, as a list of columns which
+are each a binary number with a bit for each row, so the distance a tetromino can drop is found without testing each
+row """
+import Constants
+
+# The value of a row in which every position is occupied
+FULL_ROW = (1 << Constants.BOARD_WIDTH) - 1
+
+
+def find_complete_rows(board, first_row, last_row):
+    """ Returns the rows from first_row up to but not including last_row which are complete, in ascending order """
+    return [row for row in range(first_row, min(last_row, Constants.BOARD_HEIGHT)) if board[row] == FULL_ROW]
+
+
+def remove_rows(board, rows):
+    """ Removes the given rows from the board in a single pass. Every row above a removed row moves down and an empty
+    row is added at the top of the board for each row removed """
+    if not rows:
+        return
+    removed = set(rows)
+    lowest_row = rows[-1]
+    kept = [board[row] for row in range(lowest_row) if row not in removed]
+    board[:lowest_row + 1] = [0] * len(rows) + kept
+
+
+def collides(board, masks, ypos):
+    """ Returns True if any of the tetromino's masks, shifted to its x position, overlaps the board in the rows from
+    ypos down """
+    for mask in masks:
+        if mask & board[ypos]:
+            return True
+        ypos += 1
+    return False
+
+
+def find_columns(board):
+    """ Returns the column index of a board """
+    columns = [0] * Constants.BOARD_WIDTH
+    for row in range(Constants.BOARD_HEIGHT):
+        remaining = board[row]
+        while remaining:
+            lowest_bit = remaining & -remaining
+            columns[lowest_bit.bit_length() - 1] |= 1 << row
+            remaining ^= lowest_bit
+    return columns
+
+
+def add_to_columns(columns, orientation, xpos, ypos):
+    """ Adds a tetromino in the given rotation and position to a column index """
+    for column, row in orientation.cells:
+        columns[xpos + column] |= 1 << (ypos + row)
+
+
+def remove_rows_from_columns(columns, rows):
+    """ Removes the given complete rows, in ascending order, from a column index as remove_rows does from a board """
+    for row in rows:
+        below_mask = (1 << row) - 1
+        above_mask = ~((1 << (row + 1)) - 1)
+        for column in range(Constants.BOARD_WIDTH):
+            columns[column] = ((columns[column] & below_mask) << 1) | (columns[column] & above_mask)
+
+
+def drop_distance(columns, orientation, xpos, ypos):
+    """ Returns the number of rows a tetromino in the given rotation and position can drop before it collides with the
+    board or reaches the bottom, from the lowest occupied position in each of its columns """
+    distance = Constants.BOARD_HEIGHT
+    for column, _, bottom in orientation.profile:
+        first_row = ypos + bottom + 1
+        below = columns[xpos + column] >> first_row
+        # The lowest set bit of below is the first occupied position beneath the tetromino in the column
+        column_distance = (below & -below).bit_length() - 1 if below else Constants.BOARD_HEIGHT - first_row
+        if column_distance < distance:
+            distance = column_distance
+    return distance
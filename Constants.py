@@ -1,16 +1,60 @@
 """ Store global constants """
+import ast
+import os
+
+
+def setting(name, default):
+    """ Returns the value of the environment variable TETRIS_<name> parsed as a Python literal, or default if it isn't
+    set. Values which aren't literals are returned as strings """
+    value = os.environ.get("TETRIS_" + name)
+    if value is None:
+        return default
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
 # LEDmatrix configuration
-CHAIN_LENGTH = 3
-PARALLEL_CHAINS = 2
+# The dimensions of a single LED panel in pixels
+PANEL_WIDTH = setting("PANEL_WIDTH", 32)
+PANEL_HEIGHT = setting("PANEL_HEIGHT", 32)
+# The number of panels across and down the wall
+PANELS_ACROSS = setting("PANELS_ACROSS", 3)
+PANELS_DOWN = setting("PANELS_DOWN", 2)
+# The number of chains driven in parallel, each covering an equal number of the wall's rows of panels
+PARALLEL_CHAINS = setting("PARALLEL_CHAINS", 2)
+CHAIN_LENGTH = PANELS_ACROSS * PANELS_DOWN // PARALLEL_CHAINS
+# How a chain covering more than one row of panels is wired, "Z" if each row of panels runs left to right or "U" if
+# every other row runs back right to left with its panels mounted upside down
+PANEL_MAPPING = setting("PANEL_MAPPING", "Z")
 LED_BRIGHTNESS = 100
+# The maximum number of frames per second sent to the matrices
+MAX_FRAME_RATE = 60
+# Where frames are shown, "matrix" for the LED matrices, "null" to discard them, "framebuffer" to keep the latest in
+# memory or "png" to write the latest to DISPLAY_PNG_PATH
+DISPLAY_BACKEND = setting("DISPLAY_BACKEND", "matrix")
+DISPLAY_PNG_PATH = setting("DISPLAY_PNG_PATH", "frame.png")
 
 # The dimensions of the board
-BOARD_WIDTH = 96
-BOARD_HEIGHT = 64
+BOARD_WIDTH = PANEL_WIDTH * PANELS_ACROSS
+BOARD_HEIGHT = PANEL_HEIGHT * PANELS_DOWN
 
 # Game properties
-NUM_GAMES = 6
+NUM_GAMES = setting("NUM_GAMES", 6)
 GAME_SPEED = 150
+SEEK_SPEED = 20
+
+# The number of worker processes used to search for tetromino positions in parallel, 0 searches in the heuristic thread
+HEURISTIC_PROCESSES = 0
+# The number of tetrominoes the heuristic considers when placing one, including those next in the game's queue
+LOOKAHEAD_DEPTH = 1
+# The number of the best scoring positions searched further at each level of lookahead
+LOOKAHEAD_BEAM = 4
+# The time the heuristic may spend looking ahead for a tetromino before using the best position so far (milliseconds)
+LOOKAHEAD_BUDGET = 50
+# The backend used to score candidate placements, either "python" or "numpy" which requires numpy to be installed
+SCORING_BACKEND = "python"
 
 # Heuristic factors
 COMPLETE_LINES_FACTOR = 50
@@ -19,3 +63,24 @@ NEARBY_EMPTY_SPACES_FACTOR = -1
 AVERAGE_COLUMN_HEIGHT_FACTOR = -5
 HEIGHT_VARIATION_FACTOR = -0.6
 DISTANCE_FACTOR = 0.01
+# A JSON profile of heuristic factors written by Tuner.py which replaces the factors above, None to use them as they are
+HEURISTIC_PROFILE = None
+
+# Metrics, recorded for the hot paths of the game loop when enabled
+METRICS_ENABLED = False
+# The number of recent latencies kept for each hot path
+METRICS_WINDOW = 1024
+# The localhost port the metrics are served on as JSON, 0 to disable
+METRICS_PORT = 8765
+# The number of seconds between printing the metrics, 0 to disable
+METRICS_DUMP_INTERVAL = 0
+
+# A file the frames shown on the wall are recorded to with Recorder.py, None to disable recording
+RECORDING_PATH = None
+# The number of frames which may wait to be written to the recording before frames are dropped
+RECORDER_QUEUE_SIZE = 256
+
+# The number of seconds after a game ends before a new one begins, None to wait for a restart to be requested
+AUTO_RESTART_DELAY = setting("AUTO_RESTART_DELAY", 10)
+# A unix socket the running wall accepts restart, quit and status commands on with Control.py, None to disable
+CONTROL_SOCKET = setting("CONTROL_SOCKET", None)
@@ -0,0 +1,55 @@
+""" Control of a running wall without reading stdin. Commands are read a line at a time from clients of a local unix
+socket at CONTROL_SOCKET and each is answered with a line of JSON. SIGUSR1 requests a new game and SIGINT and SIGTERM
+request a quit, the same as the restart and quit commands """
+import json
+import os
+import signal
+import socketserver
+import threading
+
+# The commands accepted on the socket. A restart ends the game in progress, status only returns the reply
+COMMANDS = ("restart", "quit", "status")
+# The command each signal stands for
+SIGNAL_COMMANDS = {signal.SIGUSR1: "restart", signal.SIGINT: "quit", signal.SIGTERM: "quit"}
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """ Passes each line read from a client to the server's handle_command and writes back its reply as JSON """
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode(errors="ignore").strip()
+            if command in COMMANDS:
+                reply = self.server.handle_command(command)
+            else:
+                reply = {"error": f"Unknown command {command!r}, expected one of {', '.join(COMMANDS)}"}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+def start_server(path, handle_command):
+    """ Serves commands on a unix socket at the given path from a daemon thread. handle_command is called from the
+    server's threads with each command and returns a dictionary which is sent back. Returns the server """
+    if os.path.exists(path):
+        # Left behind by a previous run which didn't shut down cleanly
+        os.unlink(path)
+    server = socketserver.ThreadingUnixStreamServer(path, ControlHandler)
+    server.daemon_threads = True
+    server.handle_command = handle_command
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stop_server(server):
+    """ Stops serving commands and removes the socket """
+    server.shutdown()
+    server.server_close()
+    if os.path.exists(server.server_address):
+        os.unlink(server.server_address)
+
+
+def install_signal_handlers(handle_command):
+    """ Calls handle_command with the command a signal stands for whenever it is received. Each command is handled in a
+    new thread, as the signal interrupts the main thread which may be holding a lock the command needs. Must be called
+    from the main thread """
+    for signal_number, command in SIGNAL_COMMANDS.items():
+        signal.signal(signal_number, lambda *_, command=command: threading.Thread(target=handle_command,
+                                                                                   args=(command,)).start())
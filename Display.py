@@ -1,25 +1,278 @@
-from rgbmatrix import RGBMatrix, RGBMatrixOptions
-from PIL import Image
+""" Display sinks which show the board display, and the frame presentation shared by the game loops. Nothing is
+created when the module is imported, the sink given by DISPLAY_BACKEND is created when the first frame is presented """
 import Constants
 
-options = RGBMatrixOptions()
-#options.rows = Constants.BOARD_HEIGHT
-#options.cols = Constants.BOARD_WIDTH
-options.chain_length = Constants.CHAIN_LENGTH
-options.parallel = Constants.PARALLEL_CHAINS
-options.brightness = Constants.LED_BRIGHTNESS
-options.hardware_mapping = 'regular'
-#options.no_hardware_pulse = 1
 
-matrix = RGBMatrix(options=options)
-offscreen_canvas = matrix.CreateFrameCanvas()
+class BoardDisplay(object):
+    """ The colour of each position on the board, stored as a contiguous BOARD_HEIGHT x BOARD_WIDTH x 3 byte buffer
+    which can be handed to the sinks without conversion """
+    def __init__(self):
+        # Three bytes per position holding its red, green and blue values, row by row from the top of the board
+        self.buffer = bytearray(Constants.BOARD_WIDTH * Constants.BOARD_HEIGHT * 3)
+        # The number of bytes in a row of the board
+        self.row_length = Constants.BOARD_WIDTH * 3
+
+    def get_colour(self, column, row):
+        """ Returns the colour of the position as an RGB tuple """
+        offset = (row * Constants.BOARD_WIDTH + column) * 3
+        return tuple(self.buffer[offset:offset + 3])
+
+    def set_colour(self, column, row, colour):
+        """ Sets the colour of the position to the given RGB tuple """
+        offset = (row * Constants.BOARD_WIDTH + column) * 3
+        self.buffer[offset:offset + 3] = bytes(colour)
+
+    def clear_colour(self, column, row):
+        """ Sets the position to black """
+        offset = (row * Constants.BOARD_WIDTH + column) * 3
+        self.buffer[offset:offset + 3] = b"\x00\x00\x00"
+
+    def remove_rows(self, rows):
+        """ Removes the given rows, in ascending order, in a single pass. Every row above a removed row moves down and
+        an empty row is added at the top of the board for each row removed """
+        if not rows:
+            return
+        segments = []
+        start = 0
+        for row in rows:
+            segments.append(self.buffer[start * self.row_length:row * self.row_length])
+            start = row + 1
+        self.buffer[len(rows) * self.row_length:(rows[-1] + 1) * self.row_length] = b"".join(segments)
+        self.buffer[:len(rows) * self.row_length] = bytes(len(rows) * self.row_length)
+
+    def to_image(self):
+        """ Returns the board display as a PIL image """
+        from PIL import Image
+        return Image.frombuffer("RGB", (Constants.BOARD_WIDTH, Constants.BOARD_HEIGHT), bytes(self.buffer), "raw",
+                                "RGB", 0, 1)
+
+
+class NullDisplay(object):
+    """ Display sink which discards every frame, used when running the game logic headless """
+    def render(self, board_display, dirty_cells):
+        pass
+
+
+class FramebufferDisplay(object):
+    """ Display sink which keeps a copy of the most recent frame in memory """
+    def __init__(self):
+        # The most recently rendered frame, three bytes per position in the same layout as BoardDisplay
+        self.frame = bytearray(Constants.BOARD_WIDTH * Constants.BOARD_HEIGHT * 3)
+        # The number of frames rendered since the sink was created
+        self.frame_count = 0
+
+    def render(self, board_display, dirty_cells):
+        self.frame[:] = board_display.buffer
+        self.frame_count += 1
+
+    def to_image(self):
+        """ Returns the most recent frame as a PIL image """
+        from PIL import Image
+        return Image.frombuffer("RGB", (Constants.BOARD_WIDTH, Constants.BOARD_HEIGHT), bytes(self.frame), "raw",
+                                "RGB", 0, 1)
+
+
+class PngDisplay(FramebufferDisplay):
+    """ Display sink which keeps the most recent frame in memory and writes it to a PNG file, for previewing the wall
+    without the hardware """
+    def __init__(self, path):
+        super().__init__()
+        # The file each frame is written to
+        self.path = path
+
+    def render(self, board_display, dirty_cells):
+        super().render(board_display, dirty_cells)
+        self.to_image().save(self.path)
+
+
+class PanelLayout(object):
+    """ Maps the panels of the wall, PANELS_ACROSS by PANELS_DOWN, to the canvas of the chains driving them. The canvas
+    holds each chain's panels side by side in the order they are chained, with the PARALLEL_CHAINS chains stacked top to
+    bottom. Each chain covers an equal number of the wall's rows of panels, wired as given by PANEL_MAPPING """
+    def __init__(self):
+        if Constants.PANEL_MAPPING not in ("Z", "U"):
+            raise ValueError(f"Unknown panel mapping {Constants.PANEL_MAPPING!r}, expected 'Z' or 'U'")
+        if Constants.PANELS_DOWN % Constants.PARALLEL_CHAINS:
+            raise ValueError(f"{Constants.PANELS_DOWN} rows of panels can't be split between "
+                             f"{Constants.PARALLEL_CHAINS} parallel chains")
+        rows_per_chain = Constants.PANELS_DOWN // Constants.PARALLEL_CHAINS
+        # The board and canvas positions of the top left pixel of each panel, and whether the panel is upside down,
+        # as (board_x, board_y, canvas_x, canvas_y, rotated) ordered by panel number, left to right and top to bottom
+        self.panels = []
+        for panel_row in range(Constants.PANELS_DOWN):
+            chain, chain_row = divmod(panel_row, rows_per_chain)
+            rotated = Constants.PANEL_MAPPING == "U" and chain_row % 2 == 1
+            for panel_column in range(Constants.PANELS_ACROSS):
+                chain_column = Constants.PANELS_ACROSS - 1 - panel_column if rotated else panel_column
+                self.panels.append((panel_column * Constants.PANEL_WIDTH, panel_row * Constants.PANEL_HEIGHT,
+                                    (chain_row * Constants.PANELS_ACROSS + chain_column) * Constants.PANEL_WIDTH,
+                                    chain * Constants.PANEL_HEIGHT, rotated))
+        # Whether every panel is at the same position on the canvas as on the board, so frames can be drawn unchanged
+        self.is_identity = all(board_x == canvas_x and board_y == canvas_y and not rotated
+                               for board_x, board_y, canvas_x, canvas_y, rotated in self.panels)
+
+    def find_panels(self, dirty_cells):
+        """ Returns the numbers of the panels containing the given cell indices, or every panel if dirty_cells is
+        None """
+        if dirty_cells is None:
+            return set(range(len(self.panels)))
+        panels = set()
+        for index in dirty_cells:
+            row, column = divmod(index, Constants.BOARD_WIDTH)
+            panels.add(row // Constants.PANEL_HEIGHT * Constants.PANELS_ACROSS + column // Constants.PANEL_WIDTH)
+        return panels
+
+
+class MatrixDisplay(object):
+    """ Display sink which drives the physical LED matrices. Only the panels which changed are written to the canvas """
+    def __init__(self):
+        from rgbmatrix import RGBMatrix, RGBMatrixOptions
+
+        options = RGBMatrixOptions()
+        options.rows = Constants.PANEL_HEIGHT
+        options.cols = Constants.PANEL_WIDTH
+        options.chain_length = Constants.CHAIN_LENGTH
+        options.parallel = Constants.PARALLEL_CHAINS
+        options.brightness = Constants.LED_BRIGHTNESS
+        options.hardware_mapping = 'regular'
+        #options.no_hardware_pulse = 1
+
+        self.layout = PanelLayout()
+        self.matrix = RGBMatrix(options=options)
+        self.offscreen_canvas = self.matrix.CreateFrameCanvas()
+        # The panels changed in the previous frame. The canvases are double buffered so the offscreen canvas is one
+        # frame behind and needs those panels as well as the current ones
+        self.previous_panels = set(range(len(self.layout.panels)))
+        # The image of the whole board and of a single panel, refilled for each frame rather than created
+        from PIL import Image
+        self.image = Image.new("RGB", (Constants.BOARD_WIDTH, Constants.BOARD_HEIGHT))
+        self.tile = Image.new("RGB", (Constants.PANEL_WIDTH, Constants.PANEL_HEIGHT))
+
+    def render(self, board_display, dirty_cells):
+        from PIL import Image
+        panels = self.layout.find_panels(dirty_cells)
+        canvas_panels = panels | self.previous_panels
+        self.previous_panels = panels
+        if not canvas_panels:
+            return
+
+        self.image.frombytes(board_display.buffer)
+        if self.layout.is_identity and len(canvas_panels) == len(self.layout.panels):
+            self.offscreen_canvas.SetImage(self.image)
+        else:
+            for panel in sorted(canvas_panels):
+                board_x, board_y, canvas_x, canvas_y, rotated = self.layout.panels[panel]
+                self.tile.paste(self.image, (-board_x, -board_y))
+                tile = self.tile.transpose(Image.ROTATE_180) if rotated else self.tile
+                self.offscreen_canvas.SetImage(tile, canvas_x, canvas_y)
+        self.offscreen_canvas = self.matrix.SwapOnVSync(self.offscreen_canvas)
+
+
+# The sink which frames are sent to, None until it is set or created from DISPLAY_BACKEND for the first frame
+sink = None
+# The board display waiting to be shown by the next call to present, None if nothing has changed
+pending_display = None
+# The indices of the cells which have changed since the last frame, None if the whole board must be redrawn
+dirty_cells = None
+# The time at which the last frame was sent to the sink
+last_frame_time = None
+
+
+def create_sink(backend=None):
+    """ Returns a new sink for the named backend, DISPLAY_BACKEND by default. The backend is "matrix" for the LED
+    matrices, "null" to discard frames, "framebuffer" to keep the latest frame in memory or "png" to also write it to
+    DISPLAY_PNG_PATH. Frames are recorded to RECORDING_PATH if it is set """
+    backend = backend or Constants.DISPLAY_BACKEND
+    if backend == "matrix":
+        new_sink = MatrixDisplay()
+    elif backend == "null":
+        new_sink = NullDisplay()
+    elif backend == "framebuffer":
+        new_sink = FramebufferDisplay()
+    elif backend == "png":
+        new_sink = PngDisplay(Constants.DISPLAY_PNG_PATH)
+    else:
+        raise ValueError(f"Unknown display backend {backend!r}, expected 'matrix', 'null', 'framebuffer' or 'png'")
+    if Constants.RECORDING_PATH:
+        import Recorder
+        new_sink = Recorder.RecordingDisplay(Constants.RECORDING_PATH, new_sink)
+    return new_sink
+
+
+def get_sink():
+    """ Returns the sink which frames are sent to, creating it from DISPLAY_BACKEND if none has been set """
+    global sink
+    if sink is None:
+        sink = create_sink()
+    return sink
+
+
+def set_sink(new_sink):
+    """ Sets the sink which frames are sent to """
+    global sink
+    global last_frame_time
+    sink = new_sink
+    last_frame_time = None
+    invalidate()
+
+
+def close_sink():
+    """ Closes the sink if it holds anything which must be closed, such as a recording which writes its queued frames
+    and index when closed, and forgets it so the next frame creates a new one """
+    global sink
+    if sink is not None and hasattr(sink, "close"):
+        sink.close()
+    sink = None
+
+
+def invalidate():
+    """ Records that the whole board must be redrawn in the next frame """
+    global dirty_cells
+    dirty_cells = None
+
+
+def mark_dirty(index):
+    """ Records that the cell at the given index of the board display has changed """
+    if dirty_cells is not None:
+        dirty_cells.add(index)
+
+
+def mark_rows_dirty(first_row, last_row):
+    """ Records that every cell in the rows first_row to last_row inclusive has changed """
+    if dirty_cells is not None:
+        dirty_cells.update(range(first_row * Constants.BOARD_WIDTH, (last_row + 1) * Constants.BOARD_WIDTH))
 
 
 def update_display(board_display):
-    """ Takes the board display which is a list of RGB tuples and sets the display of the panels """
-    global offscreen_canvas
-    global matrix
-    image = Image.new("RGB", (Constants.BOARD_WIDTH, Constants.BOARD_HEIGHT))
-    image.putdata(board_display)
-    offscreen_canvas.SetImage(image.convert('RGB'))
-    offscreen_canvas = matrix.SwapOnVSync(offscreen_canvas)
+    """ Requests that the board display is shown on the panels. Every change requested before
+    the next call to present is shown in a single frame """
+    global pending_display
+    pending_display = board_display
+
+
+def next_frame_time():
+    """ Returns the earliest time at which present will send the requested frame, or None if no frame is requested """
+    if pending_display is None:
+        return None
+    if last_frame_time is None:
+        return 0
+    return last_frame_time + 1 / Constants.MAX_FRAME_RATE
+
+
+def present(current_time):
+    """ Sends the requested frame to the sink if the maximum frame rate allows it. Returns True if a frame was sent. The
+    set of dirty cells is emptied and reused for the next frame, so sinks must not keep it """
+    global pending_display
+    global dirty_cells
+    global last_frame_time
+
+    if pending_display is None or current_time < next_frame_time():
+        return False
+    get_sink().render(pending_display, dirty_cells)
+    pending_display = None
+    if dirty_cells is None:
+        dirty_cells = set()
+    else:
+        dirty_cells.clear()
+    last_frame_time = current_time
+    return True
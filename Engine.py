@@ -0,0 +1,80 @@
+""" Headless engine which runs the game logic in Game without the LED matrix, the heuristic thread or the wall clock """
+import time
+import Constants
+import Display
+import Game
+
+
+class Engine(object):
+    """ Drives a game one logical tick at a time. A tick is the time it takes a tetromino to drop one row, so each call
+    to step decides the position of any new tetrominoes, moves every falling tetromino to its goal and drops it one
+    row, without sleeping """
+    def __init__(self, sink=None, seed=None):
+        # The display sink frames are sent to, frames are discarded by default
+        self.sink = sink if sink is not None else Display.NullDisplay()
+        # The number of ticks since the game began
+        self.ticks = 0
+        # The number of tetrominoes dropped at the start of the game, one per game
+        self.drop_count = 0
+        # The wall clock time in seconds each tetromino waited for the heuristic to decide its position
+        self.decision_latencies = []
+        # The total wall clock time in seconds spent deciding positions. Tetrominoes decided together share one search,
+        # so it is counted once for all of them rather than summed from the latencies
+        self.decision_time = 0.0
+        self.reset(seed)
+
+    def reset(self, seed=None):
+        """ Begins a new game. Games begun with the same seed play out identically """
+        self.ticks = 0
+        self.drop_count = 0
+        self.decision_latencies = []
+        self.decision_time = 0.0
+        Game.random_generator.seed(seed)
+        Display.set_sink(self.sink)
+        Game.clock = self.clock
+        Game.initialise_game()
+
+    def clock(self):
+        """ Returns the logical time in seconds """
+        return self.ticks * Constants.GAME_SPEED / 1000
+
+    def step(self):
+        """ Advances the game by one tick. Returns False once the game is over """
+        if Game.game_over:
+            return False
+        self.ticks += 1
+
+        # Stagger the initial drops the same way play_game does
+        while self.drop_count < Constants.NUM_GAMES and \
+                self.ticks * Constants.NUM_GAMES >= (self.drop_count + 1) * Constants.BOARD_HEIGHT:
+            if not Game.add_next_tetromino(self.drop_count):
+                Game.game_over = True
+                return False
+            self.drop_count += 1
+
+        tetrominoes = Game.take_waiting_tetrominoes()
+        if tetrominoes:
+            start_time = time.perf_counter()
+            Game.decide_best_positions(tetrominoes)
+            elapsed = time.perf_counter() - start_time
+            self.decision_latencies += [elapsed] * len(tetrominoes)
+            self.decision_time += elapsed
+        # Between drops play_game seeks many times, so move the tetrominoes as far as they will go
+        while Game.seek_goal_positions():
+            pass
+
+        for tetromino in list(Game.falling_tetrominoes):
+            tetromino.last_drop_time = self.clock()
+            if not Game.drop_tetromino(tetromino):
+                Game.game_over = True
+                break
+        # Show every change made in the tick in a single frame
+        Display.present(self.clock())
+        return not Game.game_over
+
+    def run(self, max_ticks=None):
+        """ Steps until the game is over or max_ticks have elapsed. Returns the number of lines cleared """
+        while max_ticks is None or self.ticks < max_ticks:
+            if not self.step():
+                break
+        return Game.cleared_lines
@@ -1,21 +1,38 @@
+import gc
 import threading
+import queue
+import collections
 import time
 import sys
-import copy
-from random import shuffle
+import random
 import Tetrominoes
 import Display
+import Board
 import Constants
+import Heuristic
+import Placement
+import Control
 
 # Maintain three global versions of the board. The first contains only the tetrominoes which have been placed on the
 # board via a collision. It is an arrays of binary numbers, each representing a row starting at the top of the board,
 # where each bit indicates whether the position is occupied.
 board = []
+# The column index of board from Board.find_columns, used to find how far a falling tetromino can drop in one call
+board_columns = []
 # This contains the placed tetrominoes as well as the final position of any falling tetrominoes once they have been
 # decided and is structured the same as board.
 board_decided = []
-# The third is an array of RGB tuples storing the colour of each position. This does include any falling tetrominoes.
-board_display = []
+# The Placement.BoardState holding board_decided as its rows, which keeps the features scored by the heuristic up to date
+# as tetrominoes are decided and rows cleared
+board_state = Placement.BoardState()
+# Incremented whenever rows are cleared from board_decided or it is reset. The heuristic searches a snapshot of
+# board_state and only commits its decision if the version hasn't changed, otherwise it searches again
+board_version = 0
+# Guards board_state and board_version. It is held only to take a snapshot, commit a decision or clear rows, never
+# while searching, so the game loop never waits on the heuristic
+state_lock = threading.Lock()
+# The third is a Display.BoardDisplay storing the colour of each position. This does include any falling tetrominoes.
+board_display = None
 # The game speed defines the number of milliseconds it takes for a block to fall one row
 game_speed = Constants.GAME_SPEED
 # The queues of tetrominoes which define the order in which tetrominoes will drop for each game
@@ -23,53 +40,93 @@ queues = [[] for _ in range(Constants.NUM_GAMES)]
 # A list of length NUM_GAMES, where each item is a list of tetrominoes falling within a given game. Tetrominoes remain
 # in their respective list until they collide with a piece or the bottom of the game
 falling_tetrominoes = []
-# Queue for tetrominoes to be process by heuristic
-heuristic_queue = []
+# Queue for tetrominoes to be process by heuristic, the heuristic thread blocks on it until a tetromino is added
+heuristic_queue = queue.Queue()
+# Worker processes which search for tetromino positions, created when first needed if HEURISTIC_PROCESSES is above zero
+heuristic_pool = None
+# Set by the heuristic thread when it decides a position to wake the game loop so the tetromino can start seeking
+decision_event = threading.Event()
+# The thread running calculate_best_positions, started by the first game and reused by every game after it
+heuristic_thread = None
 # Game over signal to allow thread to signify game end
 game_over = False
 cleared_lines = 0
-highest_row = Constants.BOARD_HEIGHT
+# The number of tetrominoes placed on the board this game
+placed_tetrominoes = 0
+# The number of games begun since the process started
+games_played = 0
+# Set to wake the session when a new game or a quit is requested by a signal or the control socket
+session_event = threading.Event()
+# Whether a quit has been requested, the session ends with the game in progress
+quit_requested = False
+# The source of randomness for the tetromino queues, seeded by the headless engine so games can be replayed
+random_generator = random.Random()
+# The function used to read the current time in seconds. The headless engine replaces this with a logical clock
+clock = time.time
 
 
 def initialise_game():
-    """ Initialises the data structures used to keep track of the game """
+    """ Initialises the data structures used to keep track of the game. Everything left over from a previous game is
+    reset here, so this is all that is needed to begin a new one """
+    global games_played
     initialise_board()
     initialise_decided_board()
     initialise_display_board()
     initialise_queues()
     initialise_falling_tetrominoes()
+    initialise_heuristic_queue()
+    decision_event.clear()
+    reset_game_properties()
+    games_played += 1
 
 
 def initialise_board():
     """ Initialises an empty board """
     global board
+    global board_columns
     board = [0] * Constants.BOARD_HEIGHT
+    board_columns = [0] * Constants.BOARD_WIDTH
 
 
 def initialise_decided_board():
     """ Initialises an empty decided board """
     global board_decided
-    board_decided = [0] * Constants.BOARD_HEIGHT
+    global board_version
+    with state_lock:
+        board_state.reset()
+        board_decided = board_state.rows
+        board_version += 1
 
 
 def initialise_display_board():
     """ Initialises an empty board display """
     global board_display
-    board_display = [(0, 0, 0)] * Constants.BOARD_WIDTH * Constants.BOARD_HEIGHT
+    board_display = Display.BoardDisplay()
+    Display.invalidate()
+    Display.update_display(board_display)
 
 
 def initialise_queues():
     """ Initialise the tetromino queues which define the order in which tetrominoes are added to the board. The queue
-    is a random permutation of the 7 possible tetromino ids (0..6) """
+    is made of random permutations of the 7 possible tetromino ids (0..6) """
     global queues
     for game in range(Constants.NUM_GAMES):
-        generate_queue(game)
+        queues[game] = []
+        top_up_queue(game, Constants.LOOKAHEAD_DEPTH)
 
 
 def generate_queue(game):
-    """ Generates the queue for the given game """
-    queues[game] = list(range(7))
-    shuffle(queues[game])
+    """ Appends a random permutation of the 7 tetromino ids to the queue for the given game """
+    tetromino_ids = list(range(7))
+    random_generator.shuffle(tetromino_ids)
+    queues[game] += tetromino_ids
+
+
+def top_up_queue(game, length):
+    """ Generates more of the game's queue until it holds at least length tetrominoes. The queue is topped up before it
+    runs out so the heuristic's lookahead isn't cut short at the end of each permutation """
+    while len(queues[game]) < length:
+        generate_queue(game)
 
 
 def initialise_falling_tetrominoes():
@@ -78,212 +135,319 @@ def initialise_falling_tetrominoes():
     falling_tetrominoes = []
 
 
+def initialise_heuristic_queue():
+    """ Empties the heuristic queue of any tetrominoes left over from a previous game """
+    while True:
+        try:
+            heuristic_queue.get_nowait()
+        except queue.Empty:
+            break
+
+
 def play_game():
-    """ Main game loop which handles the descent timing """
+    """ Main game loop which handles the descent timing. Rather than polling the clock, the loop sleeps until the next
+    drop, seek move or initial drop is due or the heuristic thread decides a position """
     global game_over
-    global falling_tetrominoes
 
     drop_count = 0
-    last_dropped_time = time.time()
+    last_dropped_time = clock()
+    last_seek_time = last_dropped_time
 
-    heuristic_thread = threading.Thread(target=calculate_best_positions)
-    heuristic_thread.start()
+    start_heuristic_thread()
 
     while True:
         # Drop tetrominoes at the start of the game
         if drop_count < Constants.NUM_GAMES:
             if handle_dropping_tetrominoes(drop_count, last_dropped_time):
                 drop_count += 1
-                last_dropped_time = time.time()
+                last_dropped_time = clock()
 
         if game_over:
             break
-        # Check if the tetromino needs to descend
-        current_time = time.time()
-        for tetromino in falling_tetrominoes:
-            if tetromino.goal_xpos != -1:
-                # Seek goal position
-                if tetromino.goal_xpos != tetromino.xpos:
-                    if tetromino.goal_xpos < tetromino.xpos:
-                        attempt_move_left(tetromino)
-                    else:
-                        attempt_move_right(tetromino)
-                if tetromino.goal_rotation != tetromino.rotation:
-                    attempt_rotation(tetromino)
-
-            if (current_time - tetromino.last_drop_time) * 1000 > game_speed:
-                tetromino.last_drop_time = current_time
-                if not attempt_drop_one_row(tetromino):
-                    # Collision occurs, attach to board and attempt to drop next tetromino
-                    if not place_tetromino_and_create_next(tetromino):
-                        game_over = True
-                        break
+        current_time = clock()
+        if (current_time - last_seek_time) * 1000 >= Constants.SEEK_SPEED:
+            last_seek_time = current_time
+            seek_goal_positions()
+        # Check if the tetrominoes need to descend
+        if not drop_tetrominoes(current_time):
+            game_over = True
+            break
+        # Show every change made in this pass in a single frame
+        Display.present(clock())
+
+        wait_for_next_event(next_deadline(drop_count, last_dropped_time, last_seek_time))
+
+    wait_for_heuristic()
+
+
+def next_deadline(drop_count, last_dropped_time, last_seek_time):
+    """ Returns the time at which the game loop next has work to do, or None if it only needs to wait for the heuristic
+    """
+    deadlines = [tetromino.last_drop_time + game_speed / 1000 for tetromino in falling_tetrominoes]
+    if drop_count < Constants.NUM_GAMES:
+        deadlines.append(last_dropped_time + Constants.BOARD_HEIGHT / Constants.NUM_GAMES * Constants.GAME_SPEED / 1000)
+    if any(is_seeking(tetromino) for tetromino in falling_tetrominoes):
+        deadlines.append(last_seek_time + Constants.SEEK_SPEED / 1000)
+    if Display.next_frame_time() is not None:
+        deadlines.append(Display.next_frame_time())
+    return min(deadlines) if deadlines else None
+
+
+def is_seeking(tetromino):
+    """ Returns True if the tetromino has moves left in its plan """
+    return bool(tetromino.plan)
+
+
+def has_reached_goal(tetromino):
+    """ Returns True if the tetromino has not been given a goal position or is in it """
+    goal = tetromino.goal
+    return goal is None or goal == (tetromino.xpos, tetromino.rotation)
+
+
+def wait_for_next_event(deadline):
+    """ Sleeps until the deadline passes or the heuristic thread decides a position """
+    timeout = None if deadline is None else max(deadline - clock(), 0)
+    decision_event.wait(timeout)
+    decision_event.clear()
 
 
 def handle_dropping_tetrominoes(drop_count, last_dropped_time):
     """ Drops the initials tetrominoes evenly across the width of the board. Returns True if a tetromino is dropped. """
     # Space the tetromino drops evenly across NUM_GAMES games
-    if (time.time() - last_dropped_time) * 1000 >= Constants.BOARD_HEIGHT / Constants.NUM_GAMES * Constants.GAME_SPEED:
+    if (clock() - last_dropped_time) * 1000 >= Constants.BOARD_HEIGHT / Constants.NUM_GAMES * Constants.GAME_SPEED:
         add_next_tetromino(drop_count % Constants.NUM_GAMES)
         return True
     return False
 
 
-def calculate_best_positions():
-    """ Applies the heuristic to a given tetromino and sets the desired position and rotation """
-    global falling_tetrominoes
-    global heuristic_queue
-    global highest_row
+def seek_goal_positions():
+    """ Moves each falling tetromino one step along the plan to the position decided by the heuristic. Returns True if
+    any tetromino moved """
+    moved = False
+    for tetromino in falling_tetrominoes:
+        if seek_goal_position(tetromino):
+            moved = True
+    return moved
 
-    while True:
-        if heuristic_queue:
-            for tetromino in heuristic_queue:
-                max_score = None
-                best_xpos = -1
-                best_ypos = -1
-                best_rotation = -1
-
-                min_column = max(int((Constants.BOARD_WIDTH / Constants.NUM_GAMES) * tetromino.game) - 1, 0)
-                max_column = min(int((Constants.BOARD_WIDTH / Constants.NUM_GAMES) * (tetromino.game + 1)) + 1,
-                                 Constants.BOARD_WIDTH)
-
-                dummy_tetromino = copy.copy(tetromino)
-                # Test each permutation of the tetromino
-                for xpos in range(min_column, max_column):
-                    for rotation in range(len(tetromino.patterns)):
-                        dummy_tetromino.rotation = rotation
-                        set_dimensions(dummy_tetromino, tetromino)
-                        dummy_tetromino.xpos = xpos
-                        dummy_tetromino.ypos = highest_row - dummy_tetromino.height
-                        dummy_tetromino.ypos = 0
-                        # Check tetromino doesn't extend off side of board
-                        if dummy_tetromino.xpos + dummy_tetromino.width <= Constants.BOARD_WIDTH:
-                            dummy_board = board_decided.copy()
-                            # Drop the tetromino until it collides
-                            while True:
-                                if not check_row_below(dummy_tetromino, dummy_board):
-                                    break
-                            # Add tetromino to test board
-                            for row in range(dummy_tetromino.height):
-                                if dummy_tetromino.patterns[dummy_tetromino.rotation][row]:
-                                    board_row = dummy_tetromino.ypos + row
-                                    # OR the tetromino in position with the row
-                                    dummy_board[board_row] |= (dummy_tetromino.patterns[dummy_tetromino.rotation][
-                                                                   row] << dummy_tetromino.xpos)
-
-                            board_score = calculate_board_score(dummy_tetromino, tetromino.xpos, dummy_board)
-                            if max_score is None or board_score > max_score:
-                                max_score = board_score
-                                best_xpos = xpos
-                                best_ypos = dummy_tetromino.ypos
-                                best_rotation = rotation
-                tetromino.goal_xpos = best_xpos
-                tetromino.goal_rotation = best_rotation
-
-                dummy_tetromino.xpos = best_xpos
-                dummy_tetromino.ypos = best_ypos
-                dummy_tetromino.rotation = best_rotation
-                set_dimensions(dummy_tetromino, tetromino)
-                add_tetromino_to_decided(dummy_tetromino)
-                heuristic_queue.remove(tetromino)
-
-
-def set_dimensions(dummy_tetromino, tetromino):
-    """ Sets a tetrominoes width and height according to its rotation """
-    if dummy_tetromino.rotation % 2 != 0:
-        dummy_tetromino.height = tetromino.width
-        dummy_tetromino.width = tetromino.height
-    else:
-        dummy_tetromino.height = tetromino.height
-        dummy_tetromino.width = tetromino.width
 
+def seek_goal_position(tetromino):
+    """ Moves the tetromino one step along its plan. Returns True if it moved """
+    plan = tetromino.plan
+    if not plan:
+        return False
+    xpos, rotation = plan[0]
+    if attempt_move(tetromino, xpos, rotation):
+        plan.pop(0)
+        return True
+    # The board has changed since the plan was made, plan again from the current position
+    tetromino.plan = plan_path(tetromino, board)
+    return False
 
-def add_tetromino_to_decided(tetromino):
-    """ Adds the tetromino to the decided board state """
-    global board_decided
-    global highest_row
 
-    if tetromino.ypos < highest_row:
-        highest_row = tetromino.ypos
-    for row in range(tetromino.height):
-        if tetromino.patterns[tetromino.rotation][row]:
-            board_row = tetromino.ypos + row
-            # OR the tetromino in position with the row
-            board_decided[board_row] |= (tetromino.patterns[tetromino.rotation][row] << tetromino.xpos)
+def drop_tetrominoes(current_time):
+    """ Drops each falling tetromino whose drop time has elapsed. Returns False if the game is over """
+    # Iterate over a copy as placed tetrominoes are removed from the list and their replacements appended
+    for tetromino in list(falling_tetrominoes):
+        if (current_time - tetromino.last_drop_time) * 1000 >= game_speed:
+            tetromino.last_drop_time = current_time
+            if not drop_tetromino(tetromino):
+                return False
+    return True
 
 
-def check_row_below(tetromino, board):
-    """ Checks whether the tetromino could occupy the same position in the row below """
-    # If the tetromino has reached the bottom of the board the move fails
-    if tetromino.ypos + tetromino.height >= Constants.BOARD_HEIGHT:
-        return False
+def drop_tetromino(tetromino):
+    """ Drops the tetromino one row, placing it and creating the next if it collides. Returns False if the game is
+    over """
+    if not attempt_drop_one_row(tetromino):
+        # Collision occurs, attach to board and attempt to drop next tetromino
+        return place_tetromino_and_create_next(tetromino)
+    if not tetromino.plan and not has_reached_goal(tetromino):
+        # The goal could not be reached from the rows above, try again from the new row
+        tetromino.plan = plan_path(tetromino, board)
+    return True
 
-    # The tetromino would remain in the play area, check for collisions
-    tetromino.ypos += 1
-    if tetromino_collides(tetromino, board):
-        # The tetromino collides, move not possible
-        tetromino.ypos -= 1
+
+def calculate_best_positions():
+    """ Heuristic thread loop which blocks until a tetromino is added to the heuristic queue and decides the position of
+    every tetromino waiting. Any event in the queue is set once the tetrominoes before it are decided, and the loop ends
+    when None is added to the queue """
+    while True:
+        items = [heuristic_queue.get()]
+        items += take_waiting_tetrominoes()
+        tetrominoes = [item for item in items if isinstance(item, Tetrominoes.Tetromino)]
+        if tetrominoes and not game_over:
+            # The tetrominoes are already falling, so bound the time spent looking ahead for each
+            decide_best_positions(tetrominoes, Constants.LOOKAHEAD_BUDGET / 1000)
+            decision_event.set()
+        for item in items:
+            if isinstance(item, threading.Event):
+                item.set()
+        if None in items:
+            break
+
+
+def start_heuristic_thread():
+    """ Starts the heuristic thread if it isn't already running """
+    global heuristic_thread
+    if heuristic_thread is None:
+        heuristic_thread = threading.Thread(target=calculate_best_positions, daemon=True)
+        heuristic_thread.start()
+
+
+def wait_for_heuristic():
+    """ Discards the tetrominoes waiting for the heuristic and waits for any search in progress to finish, so the
+    heuristic thread can't decide a tetromino onto the next game's board and is idle until that game begins """
+    initialise_heuristic_queue()
+    if heuristic_thread is not None:
+        searched = threading.Event()
+        heuristic_queue.put(searched)
+        searched.wait()
+
+
+def stop_heuristic_thread():
+    """ Stops the heuristic thread once any search in progress has finished """
+    global heuristic_thread
+    if heuristic_thread is not None:
+        heuristic_queue.put(None)
+        heuristic_thread.join()
+        heuristic_thread = None
+
+
+def take_waiting_tetrominoes():
+    """ Removes and returns every tetromino waiting in the heuristic queue. Only one thread takes tetrominoes from the
+    queue, so it is checked for tetrominoes first rather than raising queue.Empty on every call """
+    tetrominoes = []
+    while not heuristic_queue.empty():
+        tetrominoes.append(heuristic_queue.get_nowait())
+    return tetrominoes
+
+
+def get_heuristic_pool():
+    """ Returns the pool of heuristic worker processes, creating it if it doesn't exist """
+    global heuristic_pool
+    if heuristic_pool is None:
+        import concurrent.futures
+        heuristic_pool = concurrent.futures.ProcessPoolExecutor(max_workers=Constants.HEURISTIC_PROCESSES)
+    return heuristic_pool
+
+
+def decide_best_positions(tetrominoes, budget=None):
+    """ Decides the positions of the given tetrominoes. The tetrominoes are searched in rounds, each against a single
+    snapshot of the decided board, together in one batch or in parallel in worker processes if HEURISTIC_PROCESSES is
+    above zero. The lookahead for each tetromino stops once it has run for budget seconds. The headless engine searches
+    without a budget so its games can be replayed """
+    pending = tetrominoes
+    while pending:
+        version, windows = take_board_snapshots(pending)
+        # Take every tetromino in queue order whose window doesn't overlap the window of one before it in the queue,
+        # as the decision for one can't change the scores of the other's placements which complete no rows. The rest
+        # are searched in the next round, against the board with the decisions from this round
+        batch = []
+        deferred = []
+        earlier_windows = []
+        for tetromino, window in zip(pending, windows):
+            if any(window.depends_on(other.first_column, other.first_column + other.width) for other in earlier_windows):
+                deferred.append(tetromino)
+            else:
+                batch.append((tetromino, window))
+            earlier_windows.append(window)
+
+        batch_tetrominoes = [tetromino for tetromino, _ in batch]
+        batch_windows = [window for _, window in batch]
+        next_ids = [get_next_ids(tetromino.game) for tetromino in batch_tetrominoes]
+        if Constants.HEURISTIC_PROCESSES > 0 and len(batch) > 1:
+            pool = get_heuristic_pool()
+            futures = [pool.submit(Heuristic.search_snapshot, Heuristic.take_snapshot(window, tetromino,
+                                                                                      tetromino_next_ids, budget))
+                       for window, tetromino, tetromino_next_ids in zip(batch_windows, batch_tetrominoes, next_ids)]
+            positions = [future.result() for future in futures]
+        else:
+            positions = Heuristic.search_windows(batch_windows, batch_tetrominoes, next_ids, budget)
+
+        for index, (tetromino, window, (xpos, rotation, ypos)) in enumerate(zip(batch_tetrominoes, batch_windows,
+                                                                               positions)):
+            # Whether a placement completes a row depends on every column, and clearing a row changes the height of
+            # every column above it, so a decision committed earlier in the round can change the scores of placements
+            # which complete rows anywhere on the board. A tetromino which could complete a row is searched again
+            if index > 0 and could_complete_row(window):
+                decide_best_position(tetromino, budget)
+            elif not set_decided_position(tetromino, xpos, rotation, ypos, version):
+                # Rows have been cleared since the snapshot was taken
+                decide_best_position(tetromino, budget)
+        pending = deferred
+
+
+def could_complete_row(window):
+    """ Returns whether a tetromino placed within the window's columns could complete a row of the decided board """
+    with state_lock:
+        return board_state.has_completable_row(window.first_column, window.first_column + window.width)
+
+
+def decide_best_position(tetromino, budget=None):
+    """ Applies the heuristic to a given tetromino and sets the desired position and rotation. The search is repeated
+    against a new snapshot until it can be committed """
+    while True:
+        version, (window,) = take_board_snapshots([tetromino])
+        xpos, rotation, ypos = Heuristic.search_window(window, tetromino, get_next_ids(tetromino.game), budget)
+        if set_decided_position(tetromino, xpos, rotation, ypos, version):
+            return
+
+
+def take_board_snapshots(tetrominoes):
+    """ Returns the board version and a copy of the window of the decided board state each tetromino may be placed in,
+    taken together so a decision searched against a copy can be checked when it is committed """
+    with state_lock:
+        return board_version, [board_state.window(*Heuristic.game_window(tetromino.game)) for tetromino in tetrominoes]
+
+
+def get_next_ids(game):
+    """ Returns the ids of the tetrominoes the heuristic looks ahead to, taken from the front of the game's queue """
+    top_up_queue(game, Constants.LOOKAHEAD_DEPTH - 1)
+    return queues[game][:Constants.LOOKAHEAD_DEPTH - 1]
+
+
+def set_decided_position(tetromino, xpos, rotation, ypos, version):
+    """ Commits a decision searched against the given board version. The tetromino is added to the decided board in
+    its final position, then its goal position and rotation are set and its moves planned. Returns False without
+    changing anything if rows have been cleared since the snapshot was taken or the tetromino would no longer land at
+    ypos. Once committed the heuristic releases its hold on the tetromino and must not use it again """
+    dummy_tetromino = Tetrominoes.acquire_copy(tetromino)
+    dummy_tetromino.xpos = xpos
+    dummy_tetromino.ypos = ypos
+    dummy_tetromino.rotation = rotation
+    with state_lock:
+        committed = version == board_version and board_state.landing_row(tetromino, xpos, rotation) == ypos
+        if committed:
+            add_tetromino_to_decided(dummy_tetromino)
+    Tetrominoes.release(dummy_tetromino)
+    if not committed:
         return False
 
-    # The row is clear
+    tetromino.goal = (xpos, rotation)
+    tetromino.plan = plan_path(tetromino, board)
+    Tetrominoes.release(tetromino)
     return True
 
 
-def calculate_board_score(tetromino, home_position, board):
-    """ Applies the heuristic to calculate a score for the given board state """
-    global highest_row
+def add_tetromino_to_decided(tetromino):
+    """ Adds the tetromino to the decided board state """
+    board_state.add(tetromino)
+
+
+def check_row_below(tetromino):
+    """ Checks whether the tetromino could occupy the same position in the row below and moves it there if so. The
+    row the tetromino lands at is found once and kept until it moves sideways or rotates or the board changes, so each
+    drop only compares rows """
+    if tetromino.landing_row is None:
+        tetromino.landing_row = tetromino.ypos + Board.drop_distance(board_columns, tetromino.orientation,
+                                                                     tetromino.xpos, tetromino.ypos)
+    # The tetromino has reached the bottom of the board or another tetromino, the move fails
+    if tetromino.ypos >= tetromino.landing_row:
+        return False
 
-    complete_lines = 0
-    for row in range(tetromino.height):
-        board_row = tetromino.ypos + row
-        if board[board_row] == ((1 << Constants.BOARD_WIDTH) - 1):
-            complete_lines += 1
-            for i in range(board_row + 1):
-                board[board_row - i] = board[board_row - i - 1]
-            board[0] = 0
-
-    empty_spaces_created = 0
-    empty_spaces_nearby = 0
-    column_heights = []
-    for column in range(Constants.BOARD_WIDTH):
-        empty_spaces = 0
-        column_height = 0
-        for row in range(Constants.BOARD_HEIGHT - 1, highest_row - tetromino.height - 1, -1):
-            # Bitmask to extract the column'th bit
-            position = (board[row] & (1 << column)) >> column
-            if position == 0:
-                empty_spaces += 1
-            else:
-                column_height = Constants.BOARD_HEIGHT - row
-                if empty_spaces != 0:
-                    # Count empty spaces in the same columns as this tetromino
-                    if column in [tetromino.xpos + x for x in range(tetromino.width)]:
-                        empty_spaces_nearby += empty_spaces
-                        # Count empty spaces created by this tetromino
-                        if row in [tetromino.ypos + y for y in range(tetromino.height + 1)]:
-                            empty_spaces_created += 1
-                empty_spaces = 0
-        column_heights.append(column_height)
-
-    average_column_height = sum(column_heights) / len(column_heights)
-
-    total_height_variation = 0
-    for column in range(1, len(column_heights)):
-        total_height_variation += abs(column_heights[column] - column_heights[column - 1])
-    # Wrap variation calculation to remove any preference/aversion for outermost columns
-    total_height_variation += abs(column_heights[0] - column_heights[-1])
-
-    distance = abs(tetromino.xpos - home_position)
-
-    cumulative_score = complete_lines * Constants.COMPLETE_LINES_FACTOR
-    cumulative_score += empty_spaces_created * Constants.COVERED_EMPTY_SPACES_FACTOR
-    cumulative_score += empty_spaces_nearby * Constants.NEARBY_EMPTY_SPACES_FACTOR
-    cumulative_score += average_column_height * Constants.AVERAGE_COLUMN_HEIGHT_FACTOR
-    cumulative_score += total_height_variation * Constants.HEIGHT_VARIATION_FACTOR
-    if distance <= 1:
-        cumulative_score += distance * Constants.DISTANCE_FACTOR
-
-    return cumulative_score
+    # The row is clear
+    tetromino.ypos += 1
+    return True
 
 
 def add_next_tetromino(game):
@@ -292,7 +456,7 @@ def add_next_tetromino(game):
     global board
     new_tetromino = get_next_tetromino(game)
     falling_tetrominoes.append(new_tetromino)
-    heuristic_queue.append(new_tetromino)
+    heuristic_queue.put(new_tetromino)
     if tetromino_collides(new_tetromino, board):
         return False  # Game over
 
@@ -303,114 +467,95 @@ def add_next_tetromino(game):
 
 
 def get_next_tetromino(game):
-    """ Returns an instance of the tetromino at the front of the game's queue. If the queue is empty, a new queue is
-    generated """
-    global queues
-    if not queues[game]:
-        generate_queue(game)
-    return get_tetromino(queues[game].pop(0), game)
+    """ Returns an instance of the tetromino at the front of the game's queue. The queue is topped up first so the
+    tetrominoes the heuristic looks ahead to remain once it is taken """
+    top_up_queue(game, Constants.LOOKAHEAD_DEPTH)
+    tetromino = get_tetromino(queues[game].pop(0), game)
+    tetromino.last_drop_time = clock()
+    return tetromino
 
 
 def get_tetromino(tetromino_id, game):
-    """ Returns the tetromino with the given id """
-    return {
-        0: Tetrominoes.I(game),
-        1: Tetrominoes.J(game),
-        2: Tetrominoes.L(game),
-        3: Tetrominoes.O(game),
-        4: Tetrominoes.S(game),
-        5: Tetrominoes.T(game),
-        6: Tetrominoes.Z(game)
-    }.get(tetromino_id)
+    """ Returns the tetromino with the given id, reused from the pool if one has been released. It is held by the game
+    loop until it is placed and by the heuristic until its position is decided """
+    return Tetrominoes.acquire(tetromino_id, game, holders=2)
 
 
 def tetromino_collides(tetromino, board):
     """ Checks if the tetromino will collide with any others on the board and returns True if a collision occurs """
-    for row in range(tetromino.height):
-        if tetromino.patterns[tetromino.rotation][row]:
-            # Bitwise AND the tetromino pattern in position with the board, collision occurs if result > 0
-            tetromino_bit_pattern = tetromino.patterns[tetromino.rotation][row] << tetromino.xpos
-            if tetromino_bit_pattern & board[tetromino.ypos + row]:
-                return True
-    return False
+    # Bitwise AND the tetromino pattern in position with the board, collision occurs if result > 0
+    return Board.collides(board, tetromino.shape.rotations[tetromino.rotation].masks[tetromino.xpos], tetromino.ypos)
 
 
-def attempt_rotation(tetromino):
-    """ Checks if the tetromino can be rotated and does so if possible """
-    # After rotation, the height and width of the block will have swapped, check it still fits in the play area
-    if tetromino.xpos + tetromino.height > Constants.BOARD_WIDTH:
+def position_fits(tetromino, xpos, rotation, ypos, board):
+    """ Checks if the tetromino would fit in the play area at the given position and rotation without colliding with
+    the board """
+    orientation = tetromino.shape.rotations[rotation]
+    if xpos < 0 or xpos + orientation.width > Constants.BOARD_WIDTH:
         return False
-    if tetromino.ypos + tetromino.width > Constants.BOARD_HEIGHT:
+    if ypos + orientation.height > Constants.BOARD_HEIGHT:
         return False
-
-    # The tetromino would remain in the play area, check for collisions
-    tetromino.rotation = (tetromino.rotation + 1) % len(tetromino.patterns)
-    new_width = tetromino.height
-    tetromino.height = tetromino.width
-    tetromino.width = new_width
-    global board
-    if tetromino_collides(tetromino, board):
-        # The tetromino collides, move not possible
-        tetromino.rotation = (tetromino.rotation - 1) % len(tetromino.patterns)
-        new_width = tetromino.height
-        tetromino.height = tetromino.width
-        tetromino.width = new_width
-        return False
-
-    new_width = tetromino.height
-    tetromino.height = tetromino.width
-    tetromino.width = new_width
-    tetromino.rotation = (tetromino.rotation - 1) % len(tetromino.patterns)
-    remove_tetromino_from_display(tetromino)
-
-    # Perform the rotation by incrementing the value and wrapping back if we extend past the number of patterns
-    tetromino.rotation = (tetromino.rotation + 1) % len(tetromino.patterns)
-    new_width = tetromino.height
-    tetromino.height = tetromino.width
-    tetromino.width = new_width
-
-    add_tetromino_to_display(tetromino)
-
-    Display.update_display(board_display)
-    return True
-
-
-def attempt_move_left(tetromino):
-    """ Checks if the tetromino can be moved left and does so if possible """
-    if tetromino.xpos - 1 < 0:
-        return False
-
-    # The tetromino would remain in the play area, check for collisions
-    tetromino.xpos -= 1
-    global board
-    if tetromino_collides(tetromino, board):
-        tetromino.xpos += 1
-        return False
-
-    tetromino.xpos += 1
-    remove_tetromino_from_display(tetromino)
-    tetromino.xpos -= 1
-    add_tetromino_to_display(tetromino)
-
-    Display.update_display(board_display)
-    return True
-
-
-def attempt_move_right(tetromino):
-    """ Checks if the tetromino can be moved right and does so if possible """
-    if tetromino.xpos + tetromino.width + 1 > Constants.BOARD_WIDTH:
-        return False
-
-    # The tetromino would remain in the play area, check for collisions
-    tetromino.xpos += 1
-    global board
-    if tetromino_collides(tetromino, board):
-        tetromino.xpos -= 1
+    return not Board.collides(board, orientation.masks[xpos], ypos)
+
+
+def plan_path(tetromino, board):
+    """ Searches breadth first for the fewest moves left, right or rotating which take the tetromino from its current
+    position to its goal at its current row. Returns the (xpos, rotation) the tetromino is in after each move, or an
+    empty list if it is already at its goal or the goal can't be reached from this row """
+    start = (tetromino.xpos, tetromino.rotation)
+    # Read the goal and row once as the heuristic thread may decide the goal while the game loop drops the tetromino
+    goal = tetromino.goal
+    ypos = tetromino.ypos
+    if goal is None or not 0 <= goal[1] < len(tetromino.patterns) or start == goal:
+        return []
+    goal_xpos, goal_rotation = goal
+    # Try moving towards the goal before moving away from it
+    step = 1 if goal_xpos > tetromino.xpos else -1
+
+    # Most goals can be reached by moving straight towards them, shifting and then rotating each step, which avoids
+    # searching. Each step moves closer, so the route takes at most one step per column and per rotation
+    path = []
+    xpos, rotation = start
+    for _ in range(abs(goal_xpos - xpos) + len(tetromino.patterns)):
+        if (xpos, rotation) == goal:
+            break
+        if xpos != goal_xpos:
+            xpos += step
+            path.append((xpos, rotation))
+        if rotation != goal_rotation:
+            rotation = (rotation + 1) % len(tetromino.patterns)
+            path.append((xpos, rotation))
+    if (xpos, rotation) == goal and all(position_fits(tetromino, xpos, rotation, ypos, board)
+                                        for xpos, rotation in path):
+        return path
+
+    previous = {start: None}
+    frontier = collections.deque([start])
+    while frontier:
+        xpos, rotation = frontier.popleft()
+        for move in ((xpos + step, rotation), (xpos, (rotation + 1) % len(tetromino.patterns)), (xpos - step, rotation)):
+            if move in previous or not position_fits(tetromino, move[0], move[1], ypos, board):
+                continue
+            previous[move] = (xpos, rotation)
+            if move == goal:
+                path = []
+                while move != start:
+                    path.append(move)
+                    move = previous[move]
+                return path[::-1]
+            frontier.append(move)
+    return []
+
+
+def attempt_move(tetromino, xpos, rotation):
+    """ Checks if the tetromino can be moved to the given position and rotation and does so if possible """
+    if not position_fits(tetromino, xpos, rotation, tetromino.ypos, board):
         return False
 
-    tetromino.xpos -= 1
     remove_tetromino_from_display(tetromino)
-    tetromino.xpos += 1
+    tetromino.xpos = xpos
+    tetromino.rotation = rotation
+    tetromino.landing_row = None
     add_tetromino_to_display(tetromino)
 
     Display.update_display(board_display)
@@ -421,8 +566,7 @@ def attempt_drop_one_row(tetromino):
     """ Checks if the tetromino can move down a row and does so if possible.
     Returns false if it extends off the bottom of the playing area
     """
-    global board
-    if not check_row_below(tetromino, board):
+    if not check_row_below(tetromino):
         return False
 
     tetromino.ypos -= 1
@@ -439,95 +583,133 @@ def place_tetromino_and_create_next(tetromino):
     the tetromino is in. We then attempt to add a new tetromino at the top of the board. Returns true if this is
     successful and false if not (signifying the game is over) """
     global board
+    global placed_tetrominoes
     falling_tetrominoes.remove(tetromino)
+    placed_tetrominoes += 1
 
-    # Add the tetromino to the board representation
-    for row in range(tetromino.height):
-        if tetromino.patterns[tetromino.rotation][row]:
-            board_row = tetromino.ypos + row
-            # OR the tetromino in position with the row
-            board[board_row] |= (tetromino.patterns[tetromino.rotation][row] << tetromino.xpos)
+    # Add the tetromino to the board representation, ORing the tetromino in position with each row
+    for row, mask in enumerate(tetromino.orientation.masks[tetromino.xpos]):
+        board[tetromino.ypos + row] |= mask
+    Board.add_to_columns(board_columns, tetromino.orientation, tetromino.xpos, tetromino.ypos)
     check_for_completed_rows(tetromino)
-    return add_next_tetromino(tetromino.game)
+    # The board has changed beneath the falling tetrominoes, so their landing rows must be found again
+    for falling_tetromino in falling_tetrominoes:
+        falling_tetromino.landing_row = None
+    added = add_next_tetromino(tetromino.game)
+    # Released after its replacement is added, so the replacement is never the same instance
+    Tetrominoes.release(tetromino)
+    return added
 
 
 def check_for_completed_rows(tetromino):
     """ Checks for any completed rows and removes them. Higher rows are shifted down to fill removed rows and empty rows
-    are added at the top of the board. The display is updated if any changes are made
+    are added at the top of the board. Every completed row is removed in a single pass and the display is updated once
+    if any changes are made
     """
-    global board
-    global board_display
-    global board_decided
     global cleared_lines
-    global highest_row
+    global board_version
+
+    complete_rows = Board.find_complete_rows(board, tetromino.ypos, tetromino.ypos + tetromino.height)
+    if not complete_rows:
+        return
+    cleared_lines += len(complete_rows)
+
+    # Clear all falling tetrominoes from display
+    for falling_tetromino in falling_tetrominoes:
+        remove_tetromino_from_display(falling_tetromino)
+
+    # Shift every row above the completed rows down in board, board_decided and board_display
+    Board.remove_rows(board, complete_rows)
+    Board.remove_rows_from_columns(board_columns, complete_rows)
+    with state_lock:
+        board_state.clear_rows(complete_rows)
+        board_version += 1
+    board_display.remove_rows(complete_rows)
+    Display.mark_rows_dirty(0, complete_rows[-1])
+
+    # Add all falling tetrominoes back to the display
+    for falling_tetromino in falling_tetrominoes:
+        add_tetromino_to_display(falling_tetromino)
 
-    lines_cleared = False
-    for row in range(tetromino.height):
-        board_row = tetromino.ypos + row
-        if board[board_row] == ((1 << Constants.BOARD_WIDTH) - 1):
-            # Line is complete, clear it
-            lines_cleared = True
-            cleared_lines += 1
-            highest_row -= 1
-
-            # Clear all falling tetrominoes from display
-            for falling_tetromino in falling_tetrominoes:
-                remove_tetromino_from_display(falling_tetromino)
-
-            # Copy every row above the current row down one space in both board and board_display
-            for i in range(board_row + 1):
-                board[board_row - i] = board[board_row - i - 1]
-                board_decided[board_row - i] = board_decided[board_row - i - 1]
-                for j in range(Constants.BOARD_WIDTH):
-                    board_display[(board_row - i) * Constants.BOARD_WIDTH + j] = board_display[
-                        (board_row - i - 1) * Constants.BOARD_WIDTH + j]
-
-            # Add an empty row at the top
-            board[0] = 0
-            board_decided[0] = 0
-            for column in range(Constants.BOARD_WIDTH):
-                board_display[column] = (0, 0, 0)
-
-            # Add all falling tetrominoes back to the display
-            for falling_tetromino in falling_tetrominoes:
-                add_tetromino_to_display(falling_tetromino)
-
-    if lines_cleared:
-        Display.update_display(board_display)
+    Display.update_display(board_display)
 
 
 def add_tetromino_to_display(tetromino):
     """ Adds the entries for tetromino to the board display """
-    global board_display
-    for row in range(tetromino.height):
+    for column, row in tetromino.orientation.cells:
+        board_column = tetromino.xpos + column
         board_row = tetromino.ypos + row
-        for column in range(tetromino.width):
-            if tetromino.patterns[tetromino.rotation][row] & (1 << column):
-                # This position in the tetromino is occupied, add to display
-                board_column = tetromino.xpos + column
-                board_display[board_row * Constants.BOARD_WIDTH + board_column] = tetromino.colour
+        board_display.set_colour(board_column, board_row, tetromino.colour)
+        Display.mark_dirty(board_row * Constants.BOARD_WIDTH + board_column)
 
 
 def remove_tetromino_from_display(tetromino):
     """ Removes the entries for tetromino from the board display """
-    global board_display
-    for row in range(len(tetromino.patterns[tetromino.rotation])):
+    for column, row in tetromino.orientation.cells:
+        board_column = tetromino.xpos + column
         board_row = tetromino.ypos + row
-        for column in range(tetromino.width):
-            if tetromino.patterns[tetromino.rotation][row] & (1 << column):
-                # This position in the tetromino is occupied, remove from display
-                board_column = tetromino.xpos + column
-                board_display[board_row * Constants.BOARD_WIDTH + board_column] = (0, 0, 0)
+        board_display.clear_colour(board_column, board_row)
+        Display.mark_dirty(board_row * Constants.BOARD_WIDTH + board_column)
+
+
+def run_session():
+    """ Plays games until a quit is requested by a signal or the control socket, reusing the heuristic thread and any
+    worker processes for every game. A new game begins when one is requested, or once AUTO_RESTART_DELAY seconds have
+    passed since the last game ended if it is set """
+    server = None
+    if Constants.CONTROL_SOCKET:
+        server = Control.start_server(Constants.CONTROL_SOCKET, handle_command)
+    Control.install_signal_handlers(handle_command)
+    try:
+        while not quit_requested:
+            session_event.clear()
+            initialise_game()
+            play_game()
+            print(f'Game ended. AI cleared {cleared_lines} lines')
+            if quit_requested:
+                break
+            if Constants.AUTO_RESTART_DELAY is None:
+                print("Send SIGUSR1 or restart to the control socket to start a new game")
+            else:
+                print(f"Starting a new game in {Constants.AUTO_RESTART_DELAY} seconds")
+            session_event.wait(Constants.AUTO_RESTART_DELAY)
+    finally:
+        stop_heuristic_thread()
+        if server is not None:
+            Control.stop_server(server)
+        if heuristic_pool is not None:
+            heuristic_pool.shutdown()
+        Display.close_sink()
+
+
+def handle_command(command):
+    """ Handles a command from a signal or the control socket. A restart or quit ends the game in progress. Returns the
+    status of the session """
+    global quit_requested
+    if command == "quit":
+        quit_requested = True
+    if command in ("restart", "quit"):
+        end_game()
+        session_event.set()
+    return status()
+
+
+def end_game():
+    """ Ends the game in progress, waking the game loop so it stops """
+    global game_over
+    game_over = True
+    decision_event.set()
 
 
-def handle_game_end():
-    print(f'Game ended. AI cleared {cleared_lines} lines')
-    print("Type 'n' to start a new game")
-    while True:
-        user_input = sys.stdin.read(1)
-        if user_input == 'n':
-            reset_game_properties()
-            break
+def status():
+    """ Returns the state of the current game and of the process as a dictionary """
+    return {
+        "game_over": game_over,
+        "games_played": games_played,
+        "cleared_lines": cleared_lines,
+        "placed_tetrominoes": placed_tetrominoes,
+        "threads": threading.active_count(),
+    }
 
 
 def reset_game_properties():
@@ -536,11 +718,18 @@ def reset_game_properties():
     game_over = False
     global cleared_lines
     cleared_lines = 0
+    global placed_tetrominoes
+    placed_tetrominoes = 0
 
 
 if __name__ == "__main__":
-    # Main game loop, is broken when a tetromino is blocked from entering the playing area
-    while True:
-        initialise_game()
-        play_game()
-        handle_game_end()
+    if Constants.HEURISTIC_PROFILE:
+        import Tuner
+        Tuner.load_profile(Constants.HEURISTIC_PROFILE)
+    if Constants.METRICS_ENABLED:
+        import Metrics
+        Metrics.start_from_config(sys.modules[__name__])
+    # Everything created at startup lives as long as the process, so leave it out of the collections to shorten them
+    gc.freeze()
+    # Frames are shown on the DISPLAY_BACKEND sink, which is created when the first frame is presented
+    run_session()
@@ -0,0 +1,217 @@
+""" Placement search used by the heuristic. The search depends only on its arguments, so it can be run in the heuristic
+thread or in worker processes from a snapshot of the decided board """
+import time
+import Constants
+import Scoring
+import Tetrominoes
+
+# The width of the widest rotation of any tetromino
+MAX_TETROMINO_WIDTH = max(rotation.width for shape in Tetrominoes.shapes for rotation in shape.rotations)
+
+
+def game_columns(game):
+    """ Returns the first column and one past the last column a tetromino in the game may be placed in. Each game may
+    overlap its neighbours by one column """
+    min_column = max(int((Constants.BOARD_WIDTH / Constants.NUM_GAMES) * game) - 1, 0)
+    max_column = min(int((Constants.BOARD_WIDTH / Constants.NUM_GAMES) * (game + 1)) + 1, Constants.BOARD_WIDTH)
+    return min_column, max_column
+
+
+def game_window(game):
+    """ Returns the first column and one past the last column of the window a tetromino in the game may occupy. A
+    tetromino placed in the game's last column may extend past it by its width """
+    min_column, max_column = game_columns(game)
+    return min_column, min(max_column + MAX_TETROMINO_WIDTH - 1, Constants.BOARD_WIDTH)
+
+
+def score_candidates(board_state, tetromino, placement_columns):
+    """ Applies the heuristic to every position the tetromino could be dropped into with an x position below
+    placement_columns. Returns a list of (score, xpos, rotation, ypos) in the order the positions were tested """
+    return score_candidate_batch([(board_state, tetromino, placement_columns)])[0]
+
+
+def score_candidate_batch(searches):
+    """ Scores the candidates of several searches together, each a tuple of the arguments to score_candidates. With the
+    numpy backend the candidates of every search which complete no lines are scored in one batch. Returns the list
+    score_candidates would return for each search """
+    # The searches with candidates for the numpy scoring backend, as (board_state, tetromino, candidates, indexes,
+    # scored) where each candidate is (xpos, ypos, rotation, width, height) and has an index in scored
+    batches = []
+    scored_lists = []
+    for board_state, tetromino, placement_columns in searches:
+        dummy_tetromino = Tetrominoes.acquire_copy(tetromino)
+        candidates = []
+        candidate_indexes = []
+        scored = []
+        # Test each permutation of the tetromino
+        for xpos in range(placement_columns):
+            for rotation in range(len(tetromino.patterns)):
+                dummy_tetromino.rotation = rotation
+                dummy_tetromino.xpos = xpos
+                # Check tetromino doesn't extend off side of board
+                if dummy_tetromino.xpos + dummy_tetromino.width <= board_state.width:
+                    # Drop the tetromino until it collides
+                    dummy_tetromino.ypos = board_state.landing_row(tetromino, xpos, rotation)
+
+                    if Constants.SCORING_BACKEND == "numpy" and not Scoring.count_complete_lines(board_state,
+                                                                                                dummy_tetromino):
+                        candidates.append((xpos, dummy_tetromino.ypos, rotation, dummy_tetromino.width,
+                                           dummy_tetromino.height))
+                        candidate_indexes.append(len(scored))
+                        scored.append(None)
+                        continue
+
+                    board_score = Scoring.calculate_board_score(board_state, dummy_tetromino, tetromino.xpos)
+                    scored.append((board_score, xpos, rotation, dummy_tetromino.ypos))
+        Tetrominoes.release(dummy_tetromino)
+        scored_lists.append(scored)
+        if candidates:
+            batches.append((board_state, tetromino, candidates, candidate_indexes, scored))
+
+    if batches:
+        # Score every candidate which completes no lines in one batch
+        all_scores = Scoring.score_placement_batches([(board_state, tetromino, candidates, tetromino.xpos)
+                                                      for board_state, tetromino, candidates, _, _ in batches])
+        for (_, _, candidates, candidate_indexes, scored), scores in zip(batches, all_scores):
+            for index, (xpos, ypos, rotation, _, _), board_score in zip(candidate_indexes, candidates, scores):
+                scored[index] = (board_score, xpos, rotation, ypos)
+    return scored_lists
+
+
+def place_candidate(board_state, tetromino, xpos, rotation, ypos):
+    """ Returns a copy of the board state with the tetromino added in the given position and any completed lines
+    removed """
+    placed_state = board_state.copy()
+    dummy_tetromino = Tetrominoes.acquire_copy(tetromino)
+    dummy_tetromino.xpos = xpos
+    dummy_tetromino.rotation = rotation
+    dummy_tetromino.ypos = ypos
+    placed_state.add(dummy_tetromino)
+    complete_rows = placed_state.find_complete_rows(ypos, ypos + dummy_tetromino.height)
+    Tetrominoes.release(dummy_tetromino)
+    if complete_rows:
+        placed_state.clear_rows(complete_rows)
+    return placed_state
+
+
+def best_candidate(scored):
+    """ Returns the highest scoring candidate, keeping the first of any equal scores """
+    best = None
+    for candidate in scored:
+        if best is None or candidate[0] > best[0]:
+            best = candidate
+    return best
+
+
+def search_window(window, tetromino, next_ids=(), budget=None):
+    """ Searches for the best position of the tetromino within the window of the board state given by game_window.
+    Positions are given and returned in board columns, the search itself only touches the window's columns. Returns the
+    best position as a tuple of (xpos, rotation, ypos).
+
+    If the ids of the tetrominoes which follow in the same game are given, the best few positions are searched again
+    taking those tetrominoes into account. The search stops once it has looked ahead for budget seconds, and the best
+    position found so far is returned """
+    return search_windows([window], [tetromino], [next_ids], budget)[0]
+
+
+def search_windows(windows, tetrominoes, next_ids=None, budget=None):
+    """ Searches for the best position of each tetromino within its window, as search_window does. The positions of
+    every tetromino are scored together before any lookahead, so tetrominoes spawned at the same time share a single
+    batch. Each tetromino may look ahead for budget seconds, or without a limit if it is None. Returns a list of
+    positions as tuples of (xpos, rotation, ypos) """
+    next_ids = next_ids or [()] * len(tetrominoes)
+    local_tetrominoes = []
+    for window, tetromino in zip(windows, tetrominoes):
+        tetromino = Tetrominoes.acquire_copy(tetromino)
+        tetromino.xpos -= window.first_column
+        local_tetrominoes.append(tetromino)
+    scored_lists = score_candidate_batch([(window, tetromino, game_columns(tetromino.game)[1] - window.first_column)
+                                          for window, tetromino in zip(windows, local_tetrominoes)])
+    positions = [choose_position(window, tetromino, scored, tetromino_next_ids, budget)
+                 for window, tetromino, scored, tetromino_next_ids in zip(windows, local_tetrominoes, scored_lists,
+                                                                           next_ids)]
+    for tetromino in local_tetrominoes:
+        Tetrominoes.release(tetromino)
+    return positions
+
+
+def choose_position(window, tetromino, scored, next_ids, budget):
+    """ Returns the best of the scored candidates for a tetromino positioned within the window, looking ahead to the
+    tetrominoes with next_ids for up to budget seconds if any are given. The position is returned in board columns """
+    best = best_candidate(scored)
+    if best is None:
+        return -1, -1, -1
+    if next_ids:
+        # The budget starts with each tetromino's lookahead, so one searched after others isn't left without time
+        deadline = None if budget is None else time.time() + budget
+        # Look ahead from the best scoring positions first so the most promising are searched before the deadline.
+        # The sort is stable so equal scores keep the order they were tested in
+        beam = sorted(scored, key=lambda candidate: -candidate[0])[:Constants.LOOKAHEAD_BEAM]
+        cache = {}
+        best_value = None
+        for candidate in beam:
+            if deadline is not None and time.time() > deadline:
+                break
+            board_score, xpos, rotation, ypos = candidate
+            value = board_score + lookahead_value(place_candidate(window, tetromino, xpos, rotation, ypos), next_ids,
+                                                  tetromino.game, cache, deadline)
+            if best_value is None or value > best_value:
+                best_value = value
+                best = candidate
+    return best[1] + window.first_column, best[2], best[3]
+
+
+def lookahead_value(window, tetromino_ids, game, cache, deadline):
+    """ Returns the highest total score of placing the tetrominoes with the given ids in order within the window of the
+    board state. Values are cached against the window's rows, as the window holds the only columns a placement in the
+    game changes """
+    key = (tuple(tetromino_ids), tuple(window.rows))
+    if key in cache:
+        return cache[key]
+
+    tetromino = Tetrominoes.acquire(tetromino_ids[0], game)
+    try:
+        tetromino.xpos -= window.first_column
+        scored = score_candidates(window, tetromino, game_columns(game)[1] - window.first_column)
+        best = best_candidate(scored)
+        if best is None:
+            cache[key] = 0
+            return 0
+        if len(tetromino_ids) == 1:
+            # The last tetromino is where most lookups land, as boards reached along different paths often match
+            cache[key] = best[0]
+            return best[0]
+        if deadline is not None and time.time() > deadline:
+            # Past the deadline the remaining tetrominoes are ignored, which isn't cached as it isn't the full value
+            return best[0]
+
+        value = None
+        for board_score, xpos, rotation, ypos in sorted(scored, key=lambda candidate: -candidate[0])[
+                :Constants.LOOKAHEAD_BEAM]:
+            path_value = board_score + lookahead_value(place_candidate(window, tetromino, xpos, rotation, ypos),
+                                                       tetromino_ids[1:], game, cache, deadline)
+            if value is None or path_value > value:
+                value = path_value
+            if deadline is not None and time.time() > deadline:
+                break
+        cache[key] = value
+        return value
+    finally:
+        Tetrominoes.release(tetromino)
+
+
+def take_snapshot(window, tetromino, next_ids=(), budget=None):
+    """ Returns a compact, picklable snapshot of everything the search needs to decide the tetromino's position, given
+    the window of the board state returned by game_window """
+    return window, tetromino.id, tetromino.game, tetromino.xpos, tuple(next_ids), budget
+
+
+def search_snapshot(snapshot):
+    """ Worker process entry point which searches a snapshot taken by take_snapshot. Returns the best position as a
+    tuple of (xpos, rotation, ypos) """
+    window, tetromino_id, game, home_xpos, next_ids, budget = snapshot
+    tetromino = Tetrominoes.acquire(tetromino_id, game)
+    tetromino.xpos = home_xpos
+    position = search_window(window, tetromino, next_ids, budget)
+    Tetrominoes.release(tetromino)
+    return position
@@ -0,0 +1,155 @@
+""" Lightweight instrumentation of the game's hot paths. Installing the metrics wraps each hot function to record call
+counts and latencies in fixed size ring buffers, and nothing is wrapped until install is called so there is no
+overhead when disabled. The metrics can be served as JSON over a local HTTP endpoint or dumped to stdout periodically.
+Game and http.server are only imported once the metrics are used, so importing this module adds little to startup """
+import json
+import threading
+import time
+import Board
+import Constants
+import Display
+import Heuristic
+import Scoring
+
+# The number of histogram buckets. Bucket i counts calls which took less than 2^i microseconds, the last bucket counts
+# every slower call
+HISTOGRAM_BUCKETS = 24
+
+
+class Stage(object):
+    """ The counters and latencies recorded for a single instrumented function """
+    def __init__(self, name, capacity):
+        self.name = name
+        # The number of calls recorded
+        self.count = 0
+        # The total time spent in the function in seconds
+        self.total_time = 0.0
+        # The slowest call in seconds
+        self.max_time = 0.0
+        # The most recent latencies in seconds, written in a circle so memory use is fixed
+        self.latencies = [0.0] * capacity
+        # The index the next latency is written to
+        self.next_index = 0
+        # The number of calls falling into each power of two microsecond bucket
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def record(self, duration):
+        """ Records a call which took duration seconds """
+        self.count += 1
+        self.total_time += duration
+        if duration > self.max_time:
+            self.max_time = duration
+        self.latencies[self.next_index] = duration
+        self.next_index = (self.next_index + 1) % len(self.latencies)
+        self.histogram[min(int(duration * 1000000).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def report(self):
+        """ Returns the stage's metrics as a dictionary with times in milliseconds """
+        recent = sorted(self.latencies[:min(self.count, len(self.latencies))])
+        return {
+            "count": self.count,
+            "total_ms": self.total_time * 1000,
+            "mean_ms": self.total_time / self.count * 1000 if self.count else 0,
+            "max_ms": self.max_time * 1000,
+            "recent_p50_ms": recent[len(recent) // 2] * 1000 if recent else 0,
+            "recent_p99_ms": recent[min(int(len(recent) * 0.99), len(recent) - 1)] * 1000 if recent else 0,
+            "histogram_us": {f"<{2 ** bucket}": calls for bucket, calls in enumerate(self.histogram) if calls},
+        }
+
+
+# The functions which are instrumented, as the name of the module they are looked up from and the function's name
+HOT_PATHS = [
+    ("Heuristic", "search_windows"),
+    ("Scoring", "calculate_board_score"),
+    ("Scoring", "score_placement_batches"),
+    ("Display", "present"),
+    ("Game", "check_for_completed_rows"),
+    ("Board", "collides"),
+    ("Board", "drop_distance"),
+]
+# The stages being recorded, keyed by function name
+stages = {}
+# The original functions replaced while the metrics are installed, keyed by (module, name)
+originals = {}
+
+
+def timed(stage, function):
+    """ Returns a wrapper around the function which records the time of each call in the stage """
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stage.record(time.perf_counter() - start_time)
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+def install(capacity=None, game_module=None):
+    """ Starts recording metrics for every hot path. When Game.py is run directly it passes itself as game_module, as
+    the module being run is not the one imported under the name Game """
+    capacity = capacity or Constants.METRICS_WINDOW
+    if game_module is None:
+        import Game as game_module
+    modules = {"Board": Board, "Heuristic": Heuristic, "Scoring": Scoring, "Display": Display, "Game": game_module}
+    for module_name, name in HOT_PATHS:
+        module = modules[module_name]
+        if (module, name) in originals:
+            continue
+        stages[name] = Stage(name, capacity)
+        originals[(module, name)] = getattr(module, name)
+        setattr(module, name, timed(stages[name], originals[(module, name)]))
+
+
+def uninstall():
+    """ Stops recording metrics and restores the original functions """
+    for (module, name), function in originals.items():
+        setattr(module, name, function)
+    originals.clear()
+
+
+def report():
+    """ Returns the metrics for every stage """
+    return {name: stage.report() for name, stage in stages.items()}
+
+
+def start_http_server(port):
+    """ Serves the metrics on localhost at the given port from a daemon thread. Returns the server """
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        """ Serves the current metrics as JSON for any GET request """
+        def do_GET(self):
+            body = json.dumps(report(), indent=2).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_stdout_dump(interval):
+    """ Prints the metrics every interval seconds from a daemon thread """
+    def dump():
+        while True:
+            time.sleep(interval)
+            print(json.dumps(report()), flush=True)
+    threading.Thread(target=dump, daemon=True).start()
+
+
+def start_from_config(game_module=None):
+    """ Installs the metrics and starts the endpoints enabled in Constants """
+    if not Constants.METRICS_ENABLED:
+        return
+    install(game_module=game_module)
+    if Constants.METRICS_PORT:
+        start_http_server(Constants.METRICS_PORT)
+    if Constants.METRICS_DUMP_INTERVAL:
+        start_stdout_dump(Constants.METRICS_DUMP_INTERVAL)
@@ -0,0 +1,286 @@
+""" Board state used by the heuristic to find where a tetromino lands and to score placements without scanning the whole
+board """
+import Board
+import Constants
+
+
+def find_tops(board):
+    """ Returns the row index of the highest occupied position in each column of a board, BOARD_HEIGHT if the column is
+    empty """
+    tops = [Constants.BOARD_HEIGHT] * Constants.BOARD_WIDTH
+    unseen = (1 << Constants.BOARD_WIDTH) - 1
+    for row in range(Constants.BOARD_HEIGHT):
+        # Only the columns whose highest position has not yet been found need to be checked
+        new = board[row] & unseen
+        while new:
+            lowest_bit = new & -new
+            tops[lowest_bit.bit_length() - 1] = row
+            new ^= lowest_bit
+        unseen &= ~board[row]
+        if not unseen:
+            break
+    return tops
+
+
+class BoardState(object):
+    """ A board together with the features of it used by the heuristic. The features are updated incrementally as
+    tetrominoes are added and rows are cleared, so the landing row of a tetromino and the features of the board after
+    placing it can be found in O(tetromino width).
+
+    A state may hold a window of the board's columns, such as the columns a game's tetrominoes can be placed in. Column
+    positions are then relative to the window's first column and only the window's bits are stored in rows. The bits of
+    the other columns are kept only to find complete rows and are not read until a row is cleared. The height sum and
+    variation always cover the whole board, so scores are the same whether or not a window is used """
+    def __init__(self, board=None):
+        # The board as a list of rows, each a binary number with a bit for each column in the state
+        self.rows = [0] * Constants.BOARD_HEIGHT
+        # The board column of the first column in the state and the number of columns in the state
+        self.first_column = 0
+        self.width = Constants.BOARD_WIDTH
+        # The value of a row in which every position in the state is occupied
+        self.full_row = Board.FULL_ROW
+        # For a window, the rows of the board with the window's columns removed, otherwise None
+        self.outside_rows = None
+        # For a window, the value of an outside row in which every position is occupied
+        self.outside_full_row = 0
+        # For a window, the highest occupied positions in the columns either side of it
+        self.left_top = None
+        self.right_top = None
+        # The row index of the highest occupied position in each column, BOARD_HEIGHT if the column is empty
+        self.tops = [Constants.BOARD_HEIGHT] * Constants.BOARD_WIDTH
+        # The number of empty positions beneath the highest occupied position in each column
+        self.holes = [0] * Constants.BOARD_WIDTH
+        # The sum of the heights of every column on the board
+        self.height_sum = 0
+        # The sum of the height differences between neighbouring columns on the board, wrapping from the last column to
+        # the first
+        self.height_variation = 0
+        if board is not None:
+            self.rebuild(board)
+
+    def reset(self):
+        """ Resets the state to that of a new empty board """
+        self.__init__()
+
+    def copy(self, into=None):
+        """ Returns an independent copy of the state. If a scratch state is given the copy is written into it, reusing
+        its lists so it can be copied into repeatedly without allocating """
+        if into is None:
+            state = BoardState.__new__(BoardState)
+            state.__dict__.update(self.__dict__)
+            state.rows = self.rows.copy()
+            state.tops = self.tops.copy()
+            state.holes = self.holes.copy()
+            if self.outside_rows is not None:
+                state.outside_rows = self.outside_rows.copy()
+            return state
+
+        rows, tops, holes, outside_rows = into.rows, into.tops, into.holes, into.outside_rows
+        into.__dict__.update(self.__dict__)
+        into.rows, into.tops, into.holes = rows, tops, holes
+        rows[:] = self.rows
+        tops[:] = self.tops
+        holes[:] = self.holes
+        if self.outside_rows is not None and outside_rows is not None:
+            outside_rows[:] = self.outside_rows
+            into.outside_rows = outside_rows
+        elif self.outside_rows is not None:
+            into.outside_rows = self.outside_rows.copy()
+        return into
+
+    def window(self, first_column, last_column):
+        """ Returns a copy of the state holding only the columns from first_column up to but not including last_column.
+        The state must hold the whole board """
+        if first_column == 0 and last_column == Constants.BOARD_WIDTH:
+            return self.copy()
+
+        width = last_column - first_column
+        full_row = (1 << width) - 1
+        outside_mask = Board.FULL_ROW ^ (full_row << first_column)
+        state = BoardState.__new__(BoardState)
+        state.rows = [(row >> first_column) & full_row for row in self.rows]
+        state.first_column = first_column
+        state.width = width
+        state.full_row = full_row
+        state.outside_rows = [row & outside_mask for row in self.rows]
+        state.outside_full_row = outside_mask
+        state.left_top = self.tops[first_column - 1]
+        state.right_top = self.tops[last_column % Constants.BOARD_WIDTH]
+        state.tops = self.tops[first_column:last_column]
+        state.holes = self.holes[first_column:last_column]
+        state.height_sum = self.height_sum
+        state.height_variation = self.height_variation
+        return state
+
+    def depends_on(self, first_column, last_column):
+        """ Returns whether changing the board columns from first_column up to but not including last_column could
+        change the scores of placements in the state which complete no rows. A window depends only on its own columns
+        and the columns either side of it for those, as changes elsewhere add the same amount to each of their scores.
+        Placements which complete rows depend on every column, see has_completable_row """
+        if self.outside_rows is None:
+            return True
+        left_column = (self.first_column - 1) % Constants.BOARD_WIDTH
+        right_column = (self.first_column + self.width) % Constants.BOARD_WIDTH
+        return any(self.first_column <= column < self.first_column + self.width or column in (left_column, right_column)
+                   for column in range(first_column, last_column))
+
+    def rebuild(self, board):
+        """ Recalculates every feature from scratch for the given whole board, which the state takes ownership of """
+        self.reset()
+        self.rows = board
+        occupied = [0] * Constants.BOARD_WIDTH
+        for row in range(Constants.BOARD_HEIGHT):
+            remaining = board[row]
+            while remaining:
+                lowest_bit = remaining & -remaining
+                occupied[lowest_bit.bit_length() - 1] += 1
+                remaining ^= lowest_bit
+        self.tops = find_tops(board)
+        for column in range(Constants.BOARD_WIDTH):
+            self.holes[column] = Constants.BOARD_HEIGHT - self.tops[column] - occupied[column]
+        self.update_heights()
+
+    def update_heights(self):
+        """ Recalculates the height sum and variation of the board. A window finds the highest occupied positions of the
+        columns outside it from the outside rows """
+        tops = self.tops
+        if self.outside_rows is not None:
+            tops = find_tops(self.outside_rows)
+            tops[self.first_column:self.first_column + self.width] = self.tops
+            self.left_top = tops[self.first_column - 1]
+            self.right_top = tops[(self.first_column + self.width) % Constants.BOARD_WIDTH]
+        self.height_sum = sum(Constants.BOARD_HEIGHT - top for top in tops)
+        self.height_variation = sum(abs(tops[column] - tops[column - 1]) for column in range(Constants.BOARD_WIDTH))
+
+    def column_top(self, column, changed_tops=None):
+        """ Returns the highest occupied position in a column of the state, or in the column either side of a window.
+        Any tops given in changed_tops, keyed by column, are used in place of the state's """
+        if self.outside_rows is None:
+            column %= self.width
+        elif column < 0:
+            return self.left_top
+        elif column >= self.width:
+            return self.right_top
+        if changed_tops and column in changed_tops:
+            return changed_tops[column]
+        return self.tops[column]
+
+    def neighbour_variation(self, first_column, last_column, changed_tops=None):
+        """ Returns the height variation between each column from first_column to last_column inclusive and the column
+        to its left, wrapping around the edges of the board """
+        return sum(abs(self.column_top(column, changed_tops) - self.column_top(column - 1, changed_tops))
+                   for column in range(first_column, last_column + 1))
+
+    def count_holes(self, column):
+        """ Counts the empty positions beneath the highest occupied position in a column """
+        mask = 1 << column
+        return sum(1 for row in range(self.tops[column] + 1, Constants.BOARD_HEIGHT) if not self.rows[row] & mask)
+
+    def is_complete(self, row, bits):
+        """ Returns whether the row would be complete if its bits in the state were the given bits """
+        if bits != self.full_row:
+            return False
+        return self.outside_rows is None or self.outside_rows[row] == self.outside_full_row
+
+    def has_completable_row(self, first_column, last_column):
+        """ Returns whether a tetromino placed within the columns from first_column up to but not including last_column
+        could complete a row, as every position outside those columns is occupied in some row. The state must hold the
+        whole board """
+        outside_mask = Board.FULL_ROW ^ (((1 << (last_column - first_column)) - 1) << first_column)
+        return any(row & outside_mask == outside_mask for row in self.rows)
+
+    def find_complete_rows(self, first_row, last_row):
+        """ Returns the rows from first_row up to but not including last_row which are complete, in ascending order """
+        return [row for row in range(first_row, min(last_row, Constants.BOARD_HEIGHT))
+                if self.is_complete(row, self.rows[row])]
+
+    def add(self, tetromino):
+        """ Adds a tetromino in its current position to the board and updates the features """
+        for row, mask in enumerate(tetromino.orientation.masks[tetromino.xpos]):
+            self.rows[tetromino.ypos + row] |= mask
+
+        first_column = tetromino.xpos
+        last_column = tetromino.xpos + tetromino.width
+        self.height_variation -= self.neighbour_variation(first_column, last_column)
+        for column, top, bottom in tetromino.orientation.profile:
+            board_column = tetromino.xpos + column
+            column_top = self.tops[board_column]
+            if tetromino.ypos + bottom < column_top:
+                # Every position between the tetromino and the previous highest position is covered
+                self.holes[board_column] += column_top - tetromino.ypos - bottom - 1
+                self.height_sum += column_top - tetromino.ypos - top
+                self.tops[board_column] = tetromino.ypos + top
+            else:
+                # The tetromino was placed beneath an occupied position so the column is counted again
+                self.tops[board_column] = min(column_top, tetromino.ypos + top)
+                self.height_sum += column_top - self.tops[board_column]
+                self.holes[board_column] = self.count_holes(board_column)
+        self.height_variation += self.neighbour_variation(first_column, last_column)
+
+    def clear_rows(self, cleared_rows):
+        """ Removes cleared_rows, in ascending order, from the board and shifts the rows above them down """
+        Board.remove_rows(self.rows, cleared_rows)
+        if self.outside_rows is not None:
+            Board.remove_rows(self.outside_rows, cleared_rows)
+        cleared = set(cleared_rows)
+        for column in range(self.width):
+            top = self.tops[column]
+            if top in cleared:
+                # The highest position in the column was removed, find the next occupied position below it. Every
+                # position skipped is no longer beneath an occupied position
+                mask = 1 << column
+                row = top + 1
+                while row < Constants.BOARD_HEIGHT and not self.rows[row] & mask:
+                    row += 1
+                self.tops[column] = row
+                self.holes[column] = self.count_holes(column)
+            else:
+                # The position moves down one row for every row removed beneath it. The removed rows were complete so
+                # no empty positions were removed
+                self.tops[column] = top + sum(1 for row in cleared_rows if row > top)
+        self.update_heights()
+
+    def landing_row(self, tetromino, xpos, rotation):
+        """ Returns the row a tetromino dropped from the top of the board at the given position and rotation comes to
+        rest at """
+        landing = Constants.BOARD_HEIGHT
+        for column, _, bottom in tetromino.shape.rotations[rotation].profile:
+            row = self.tops[xpos + column] - bottom - 1
+            if row < landing:
+                landing = row
+        return max(landing, 0)
+
+    def placement_features(self, tetromino):
+        """ Returns the height sum, height variation and the empty positions beneath the highest occupied position in
+        the tetromino's columns for the board with the tetromino added in its current position, without changing the
+        state. Returns None if the tetromino does not rest above every column it covers, as only then can the features
+        be found from the changes to its columns """
+        tops = self.tops
+        changed_tops = {}
+        height_sum = self.height_sum
+        nearby_holes = 0
+        for column, top, bottom in tetromino.orientation.profile:
+            board_column = tetromino.xpos + column
+            column_top = tops[board_column]
+            if tetromino.ypos + bottom >= column_top:
+                return None
+            changed_tops[board_column] = tetromino.ypos + top
+            height_sum += column_top - tetromino.ypos - top
+            # Every position between the tetromino and the previous highest position is covered
+            nearby_holes += self.holes[board_column] + column_top - tetromino.ypos - bottom - 1
+
+        first_column = tetromino.xpos
+        last_column = tetromino.xpos + tetromino.width
+        height_variation = (self.height_variation - self.neighbour_variation(first_column, last_column) +
+                            self.neighbour_variation(first_column, last_column, changed_tops))
+        return height_sum, height_variation, nearby_holes
+
+    def outside_features(self):
+        """ Returns the height sum and height variation of the columns outside a window, excluding the variation between
+        the window and the columns either side of it, and the highest occupied positions in the columns either side.
+        A state holding the whole board returns (0, 0, None, None) """
+        if self.outside_rows is None:
+            return 0, 0, None, None
+        height_sum = self.height_sum - sum(Constants.BOARD_HEIGHT - top for top in self.tops)
+        height_variation = self.height_variation - self.neighbour_variation(0, self.width)
+        return height_sum, height_variation, self.left_top, self.right_top
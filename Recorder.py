@@ -0,0 +1,322 @@
+""" Records the frames shown on the wall to a file and plays them back. Run with python3 -m Recorder to inspect, export or
+play a recording.
+
+A recording is an append-only file starting with a header holding the board dimensions, followed by a record for each
+frame. Every record holds the frame XORed with the frame before it, so unchanged positions are zero, and keyframe
+records are XORed with a black frame so they can be decoded on their own. The XORed bytes are run-length encoded as
+spans of (zero bytes skipped, literal bytes, literals). The offset of each keyframe is written to an index file
+alongside the recording so a reader can seek to any frame by decoding from the keyframe before it """
+import argparse
+import bisect
+import mmap
+import os
+import queue
+import re
+import struct
+import threading
+import time
+from PIL import Image
+import Constants
+import Display
+
+# Identifies the file as a recording
+MAGIC = b"LEDREC1\x00"
+# The file header, holding the magic, the board width and the board height
+HEADER = struct.Struct("<8sHH")
+# The header of each record, holding its kind, the time of the frame in seconds since the recording began and the
+# length of its encoded spans
+RECORD_HEADER = struct.Struct("<BdI")
+# The header of each span, holding the number of zero bytes skipped and the number of literal bytes which follow
+SPAN_HEADER = struct.Struct("<HH")
+# Each entry in the index file, holding the number of a keyframe and the offset of its record in the recording
+INDEX_ENTRY = struct.Struct("<QQ")
+# The kinds of record
+KEYFRAME = 0
+DELTA = 1
+# The number of frames between keyframes
+KEYFRAME_INTERVAL = 300
+# Runs of non-zero bytes separated by fewer zero bytes than this are encoded as a single span, as a span header is four
+# bytes long
+NON_ZERO_SPANS = re.compile(rb"[^\x00](?:\x00{0,3}[^\x00])*", re.DOTALL)
+
+
+def index_path(path):
+    """ Returns the path of the index file for a recording """
+    return path + ".idx"
+
+
+def xor_bytes(first, second):
+    """ Returns the XOR of two byte strings of the same length """
+    return (int.from_bytes(first, "little") ^ int.from_bytes(second, "little")).to_bytes(len(first), "little")
+
+
+def encode_spans(data):
+    """ Run-length encodes the data as spans of zero bytes skipped followed by literal bytes """
+    encoded = bytearray()
+    position = 0
+    for match in NON_ZERO_SPANS.finditer(data):
+        start, end = match.span()
+        # Skips and literals longer than a span header can hold are split across several spans
+        while start - position > 0xFFFF:
+            encoded += SPAN_HEADER.pack(0xFFFF, 0)
+            position += 0xFFFF
+        while end - start > 0xFFFF:
+            encoded += SPAN_HEADER.pack(start - position, 0xFFFF)
+            encoded += data[start:start + 0xFFFF]
+            start += 0xFFFF
+            position = start
+        encoded += SPAN_HEADER.pack(start - position, end - start)
+        encoded += data[start:end]
+        position = end
+    return encoded
+
+
+def decode_spans(encoded, length):
+    """ Decodes spans written by encode_spans into data of the given length. Returns the data and the offset and length
+    of each literal """
+    data = bytearray(length)
+    literals = []
+    position = 0
+    offset = 0
+    while offset < len(encoded):
+        skip, literal_length = SPAN_HEADER.unpack_from(encoded, offset)
+        offset += SPAN_HEADER.size
+        position += skip
+        data[position:position + literal_length] = encoded[offset:offset + literal_length]
+        literals.append((position, literal_length))
+        offset += literal_length
+        position += literal_length
+    return data, literals
+
+
+class FrameWriter(object):
+    """ Writes frames to a recording from a background thread. Frames are passed through a bounded queue and dropped if
+    the queue is full, so recording never blocks the game loop """
+    def __init__(self, path, queue_size=None):
+        self.path = path
+        self.frame_size = Constants.BOARD_WIDTH * Constants.BOARD_HEIGHT * 3
+        self.queue = queue.Queue(maxsize=queue_size or Constants.RECORDER_QUEUE_SIZE)
+        # The number of frames written and the number dropped because the queue was full
+        self.frame_count = 0
+        self.dropped_frames = 0
+        # The time of the first frame, which frame times are recorded relative to
+        self.start_time = None
+        self.file = open(path, "wb")
+        self.index_file = open(index_path(path), "wb")
+        self.file.write(HEADER.pack(MAGIC, Constants.BOARD_WIDTH, Constants.BOARD_HEIGHT))
+        self.thread = threading.Thread(target=self.write_frames, daemon=True)
+        self.thread.start()
+
+    def record(self, frame, timestamp):
+        """ Queues a copy of the frame, taken at the given time in seconds, to be written. Returns False if the frame
+        was dropped """
+        try:
+            self.queue.put_nowait((bytes(frame), timestamp))
+            return True
+        except queue.Full:
+            self.dropped_frames += 1
+            return False
+
+    def write_frames(self):
+        """ Writer thread loop which encodes and writes queued frames until None is queued """
+        previous_frame = bytes(self.frame_size)
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            frame, timestamp = item
+            if self.start_time is None:
+                self.start_time = timestamp
+            offset = self.file.tell()
+            if self.frame_count % KEYFRAME_INTERVAL == 0:
+                kind = KEYFRAME
+                encoded = encode_spans(frame)
+            else:
+                kind = DELTA
+                encoded = encode_spans(xor_bytes(frame, previous_frame))
+            self.file.write(RECORD_HEADER.pack(kind, timestamp - self.start_time, len(encoded)))
+            self.file.write(encoded)
+            self.file.flush()
+            if kind == KEYFRAME:
+                # The keyframe is indexed once its record is complete so readers never find an index entry past the
+                # end of the recording
+                self.index_file.write(INDEX_ENTRY.pack(self.frame_count, offset))
+                self.index_file.flush()
+            previous_frame = frame
+            self.frame_count += 1
+
+    def close(self):
+        """ Writes every queued frame and closes the recording """
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        self.index_file.close()
+
+
+class RecordingDisplay(object):
+    """ Display sink which records every frame before passing it on to another sink. Times are read from clock, which
+    the headless engine's logical clock can be passed as. The headless engine produces frames faster than they can be
+    written, so it should be given a queue_size large enough to hold every frame to avoid dropping them """
+    def __init__(self, path, sink=None, clock=time.time, queue_size=None):
+        self.writer = FrameWriter(path, queue_size)
+        self.sink = sink if sink is not None else Display.NullDisplay()
+        self.clock = clock
+
+    def render(self, board_display, dirty_cells):
+        self.writer.record(board_display.buffer, self.clock())
+        self.sink.render(board_display, dirty_cells)
+
+    def close(self):
+        """ Writes every queued frame and closes the recording """
+        self.writer.close()
+
+
+class Replay(object):
+    """ Reads a recording through a memory map, so frames are decoded from the file's pages without reading the whole
+    file. Any frame is found by decoding forward from the keyframe before it, which is looked up in the index file """
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.width, self.height = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a recording")
+        self.frame_size = self.width * self.height * 3
+        # The number and record offset of every keyframe
+        self.keyframes = []
+        if os.path.exists(index_path(path)):
+            self.keyframes = self.read_index(index_path(path))
+        # The number of frames and the time of the last frame, found by reading the record headers after the last
+        # keyframe, or every record header if there is no index
+        self.frame_count = 0
+        self.duration = 0
+        number, offset = self.keyframes[-1] if self.keyframes else (0, HEADER.size)
+        while True:
+            record = self.read_record(offset)
+            if record is None:
+                break
+            kind, self.duration, _, next_offset = record
+            if kind == KEYFRAME and (not self.keyframes or self.keyframes[-1][0] < number):
+                self.keyframes.append((number, offset))
+            number += 1
+            offset = next_offset
+        self.frame_count = number
+
+    def read_index(self, path):
+        """ Returns the keyframes listed in an index file """
+        with open(path, "rb") as index_file:
+            index = index_file.read()
+        return [INDEX_ENTRY.unpack_from(index, offset)
+                for offset in range(0, len(index) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size)]
+
+    def __len__(self):
+        return self.frame_count
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def read_record(self, offset):
+        """ Returns the kind, time, encoded spans and the offset of the next record for the record at offset, or None if
+        there is no complete record there. The spans are a view of the memory map. A recording which is still being
+        written may end with an incomplete record """
+        if offset + RECORD_HEADER.size > len(self.data):
+            return None
+        kind, timestamp, length = RECORD_HEADER.unpack_from(self.data, offset)
+        start = offset + RECORD_HEADER.size
+        if start + length > len(self.data):
+            return None
+        return kind, timestamp, memoryview(self.data)[start:start + length], start + length
+
+    def frames(self, start=0, stop=None):
+        """ Yields (time, frame, changed cells) for each frame from start up to but not including stop. Changed cells
+        is a set of the indices of the positions which changed since the previous frame, or None if the whole frame
+        should be redrawn """
+        stop = self.frame_count if stop is None else min(stop, self.frame_count)
+        keyframe = bisect.bisect_right(self.keyframes, (start, float("inf"))) - 1
+        number, offset = self.keyframes[keyframe] if keyframe >= 0 else (0, HEADER.size)
+        frame = bytes(self.frame_size)
+        while number < stop:
+            kind, timestamp, spans, offset = self.read_record(offset)
+            data, literals = decode_spans(spans, self.frame_size)
+            changed = None
+            if kind == KEYFRAME:
+                frame = bytes(data)
+            else:
+                frame = xor_bytes(frame, data)
+                if number > start:
+                    changed = set()
+                    for literal_offset, length in literals:
+                        changed.update(range(literal_offset // 3, (literal_offset + length + 2) // 3))
+            if number >= start:
+                yield timestamp, frame, changed
+            number += 1
+
+    def frame(self, number):
+        """ Returns the frame with the given number """
+        for _, frame, _ in self.frames(number, number + 1):
+            return frame
+        raise IndexError(f"The recording has {self.frame_count} frames")
+
+    def to_image(self, frame):
+        """ Returns a frame as a PIL image """
+        return Image.frombuffer("RGB", (self.width, self.height), frame, "raw", "RGB", 0, 1)
+
+    def play(self, sink, start=0, speed=1.0):
+        """ Sends the frames from start to a display sink at the speed they were recorded, multiplied by speed """
+        board_display = Display.BoardDisplay()
+        start_time = time.time()
+        first_timestamp = None
+        for timestamp, frame, changed in self.frames(start):
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = (timestamp - first_timestamp) / speed - (time.time() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+            board_display.buffer[:] = frame
+            sink.render(board_display, changed)
+
+    def export_png(self, number, path):
+        """ Writes a frame to a PNG file """
+        self.to_image(self.frame(number)).save(path)
+
+    def export_gif(self, path, start=0, stop=None, step=1):
+        """ Writes every step'th frame from start up to but not including stop to an animated GIF, timed as they were
+        recorded """
+        images = []
+        timestamps = []
+        for number, (timestamp, frame, _) in enumerate(self.frames(start, stop)):
+            if number % step == 0:
+                images.append(self.to_image(frame))
+                timestamps.append(timestamp)
+        if not images:
+            raise IndexError(f"The recording has {self.frame_count} frames")
+        durations = [max(int((end - begin) * 1000), 10) for begin, end in zip(timestamps, timestamps[1:])]
+        images[0].save(path, save_all=True, append_images=images[1:], duration=durations + [100], loop=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspects, exports and plays recordings of the wall")
+    parser.add_argument("recording", help="the recording to read")
+    parser.add_argument("--png", help="writes the frame given by --start to this PNG file")
+    parser.add_argument("--gif", help="writes the frames from --start to --stop to this GIF file")
+    parser.add_argument("--play", action="store_true", help="plays the recording on the LED matrices")
+    parser.add_argument("--start", type=int, default=0, help="the first frame")
+    parser.add_argument("--stop", type=int, default=None, help="one past the last frame")
+    parser.add_argument("--step", type=int, default=1, help="exports every step'th frame to the GIF")
+    parser.add_argument("--speed", type=float, default=1.0, help="the playback speed")
+    args = parser.parse_args()
+
+    replay = Replay(args.recording)
+    print(f"{len(replay)} frames, {len(replay.keyframes)} keyframes, {replay.duration:.1f}s, "
+          f"{replay.width}x{replay.height}")
+    if args.png:
+        replay.export_png(args.start, args.png)
+    if args.gif:
+        replay.export_gif(args.gif, args.start, args.stop, args.step)
+    if args.play:
+        replay.play(Display.MatrixDisplay(), args.start, args.speed)
+    replay.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+""" Asyncio runtime which plays the game on the wall. Each game is driven by its own task which sleeps until its falling
+tetromino next drops or seeks, a display task presents frames at a fixed cadence and the heuristic runs in an executor
+so the event loop never blocks on a search. A new game begins AUTO_RESTART_DELAY seconds after one ends, or when one is
+requested through Control.py or by typing 'n'. Typing 'q' quits, as does the quit command. Input is read from stdin
+without blocking. Run with sudo python3 Runtime.py """
+import asyncio
+import concurrent.futures
+import gc
+import os
+import sys
+import Constants
+import Control
+import Display
+import Game
+
+
+class Runtime(object):
+    """ The tasks and events driving one process. A single runtime plays any number of games in turn, reusing the
+    heuristic executor between them """
+    def __init__(self):
+        # Runs the heuristic off the event loop. A single thread decides tetrominoes in the order they were queued, and
+        # hands searches on to the worker processes if HEURISTIC_PROCESSES is above zero
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # Set when tetrominoes are added to the heuristic queue
+        self.tetrominoes_waiting = asyncio.Event()
+        # Set for a game when the heuristic decides one of its tetrominoes, waking the game's task to start seeking
+        self.decisions = []
+        # Set when any game is over
+        self.game_ended = asyncio.Event()
+        # Set when a new game is requested, from stdin, the control socket or by a signal
+        self.restart_requested = asyncio.Event()
+        # Set when the runtime is asked to quit, from stdin, the control socket or by a signal
+        self.stop_requested = asyncio.Event()
+
+    async def run(self):
+        """ Plays games until asked to quit """
+        loop = asyncio.get_running_loop()
+        listen_for_input(loop, self.handle_input)
+        for signal_number, command in Control.SIGNAL_COMMANDS.items():
+            try:
+                loop.add_signal_handler(signal_number, self.handle_command, command)
+            except (NotImplementedError, RuntimeError):
+                # Signal handlers can only be added from the main thread on unix
+                pass
+        server = None
+        if Constants.CONTROL_SOCKET:
+            server = Control.start_server(Constants.CONTROL_SOCKET, lambda command: self.handle_command_threadsafe(
+                loop, command))
+
+        try:
+            while not self.stop_requested.is_set():
+                await self.play_game()
+                print(f'Game ended. AI cleared {Game.cleared_lines} lines')
+                if self.stop_requested.is_set():
+                    break
+                if Constants.AUTO_RESTART_DELAY is None:
+                    print("Type 'n' to start a new game")
+                else:
+                    print(f"Starting a new game in {Constants.AUTO_RESTART_DELAY} seconds, type 'n' to start it now")
+                try:
+                    await asyncio.wait_for(first_of(self.restart_requested, self.stop_requested),
+                                           Constants.AUTO_RESTART_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            stop_listening_for_input(loop)
+            if server is not None:
+                Control.stop_server(server)
+            self.executor.shutdown()
+            if Game.heuristic_pool is not None:
+                Game.heuristic_pool.shutdown()
+            Display.close_sink()
+
+    async def play_game(self):
+        """ Plays a single game until it is over or the runtime is asked to quit """
+        Game.initialise_game()
+        self.game_ended.clear()
+        self.restart_requested.clear()
+        self.tetrominoes_waiting.clear()
+        self.decisions = [asyncio.Event() for _ in range(Constants.NUM_GAMES)]
+
+        start_time = Game.clock()
+        heuristic_task = asyncio.create_task(self.decide_positions())
+        tasks = [asyncio.create_task(self.run_game(game, start_time)) for game in range(Constants.NUM_GAMES)]
+        tasks.append(asyncio.create_task(present_frames()))
+        try:
+            # A task only finishes early if it raised
+            await first_of(self.game_ended, self.stop_requested, tasks=tasks)
+        finally:
+            Game.game_over = True
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            # Let the heuristic finish the search in progress so it can't decide a tetromino onto the next game's board
+            self.tetrominoes_waiting.set()
+            await heuristic_task
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        Display.present(Game.clock())
+
+    async def run_game(self, game, start_time):
+        """ Drives the falling tetromino of a game, dropping it every GAME_SPEED milliseconds and moving it along its
+        plan every SEEK_SPEED milliseconds. The first tetrominoes of each game are staggered the same way as in
+        Game.play_game """
+        decision = self.decisions[game]
+        drop_interval = Constants.BOARD_HEIGHT / Constants.NUM_GAMES * Constants.GAME_SPEED / 1000
+        await sleep_until(None, start_time + (game + 1) * drop_interval)
+        if not Game.add_next_tetromino(game):
+            self.end_game()
+            return
+        self.tetrominoes_waiting.set()
+
+        tetromino = falling_tetromino(game)
+        last_seek_time = Game.clock()
+        while True:
+            deadline = tetromino.last_drop_time + Game.game_speed / 1000
+            if Game.is_seeking(tetromino):
+                deadline = min(deadline, last_seek_time + Constants.SEEK_SPEED / 1000)
+            await sleep_until(decision, deadline)
+
+            current_time = Game.clock()
+            if (current_time - last_seek_time) * 1000 >= Constants.SEEK_SPEED:
+                last_seek_time = current_time
+                Game.seek_goal_position(tetromino)
+            if (current_time - tetromino.last_drop_time) * 1000 >= Game.game_speed:
+                tetromino.last_drop_time = current_time
+                if not Game.drop_tetromino(tetromino):
+                    self.end_game()
+                    return
+                if tetromino not in Game.falling_tetrominoes:
+                    # The tetromino was placed and the next one in the game added to the heuristic queue
+                    tetromino = falling_tetromino(game)
+                    self.tetrominoes_waiting.set()
+
+    async def decide_positions(self):
+        """ Decides the position of every tetromino waiting in the heuristic queue in the executor, then wakes their
+        games. The task ends once the game is over """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.tetrominoes_waiting.wait()
+            self.tetrominoes_waiting.clear()
+            if Game.game_over:
+                return
+            tetrominoes = Game.take_waiting_tetrominoes()
+            if not tetrominoes:
+                continue
+            # A decided tetromino may already have been placed and reused by another game, so note the games first
+            games = {tetromino.game for tetromino in tetrominoes}
+            # The tetrominoes are already falling, so bound the time spent looking ahead for each
+            await loop.run_in_executor(self.executor, Game.decide_best_positions, tetrominoes,
+                                       Constants.LOOKAHEAD_BUDGET / 1000)
+            for game in games:
+                self.decisions[game].set()
+
+    def end_game(self):
+        """ Signals that a tetromino was blocked from entering the playing area """
+        Game.game_over = True
+        self.game_ended.set()
+
+    def handle_input(self, characters):
+        """ Handles the characters read from stdin """
+        if "q" in characters:
+            self.handle_command("quit")
+        elif "n" in characters and Game.game_over:
+            self.handle_command("restart")
+
+    def handle_command(self, command):
+        """ Handles a command from stdin, the control socket or a signal. A restart or quit ends the game in progress, so
+        the game is over by the time the command has been handled """
+        if command == "quit":
+            self.stop_requested.set()
+        elif command == "restart":
+            self.restart_requested.set()
+        if command in ("restart", "quit"):
+            self.end_game()
+
+    def handle_command_threadsafe(self, loop, command):
+        """ Handles a command from the control socket's threads on the event loop, waiting for it to be handled. Returns
+        the status of the session once the command has taken effect """
+        async def handle():
+            self.handle_command(command)
+            return Game.status()
+        return asyncio.run_coroutine_threadsafe(handle(), loop).result()
+
+
+async def present_frames():
+    """ Presents the frame requested by the game tasks as soon as MAX_FRAME_RATE allows, checking for a new frame at the
+    same cadence """
+    while True:
+        Display.present(Game.clock())
+        frame_time = Display.next_frame_time()
+        if frame_time is None:
+            await asyncio.sleep(1 / Constants.MAX_FRAME_RATE)
+        else:
+            await asyncio.sleep(max(frame_time - Game.clock(), 0))
+
+
+async def sleep_until(event, deadline):
+    """ Sleeps until the deadline, given in seconds on Game.clock, or until the event is set. The event is cleared """
+    timeout = max(deadline - Game.clock(), 0)
+    if event is None:
+        await asyncio.sleep(timeout)
+        return
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    event.clear()
+
+
+async def first_of(*events, tasks=()):
+    """ Waits until any of the events is set or any of the tasks finishes """
+    waiters = [asyncio.create_task(event.wait()) for event in events]
+    try:
+        await asyncio.wait(waiters + list(tasks), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+
+
+def falling_tetromino(game):
+    """ Returns the tetromino falling in the game, the most recently added for the game """
+    for tetromino in reversed(Game.falling_tetrominoes):
+        if tetromino.game == game:
+            return tetromino
+    return None
+
+
+def listen_for_input(loop, handle_input):
+    """ Calls handle_input with the characters read from stdin whenever it is readable. Does nothing if stdin can't be
+    watched by the event loop, such as when it is closed or redirected from a regular file """
+    def read_input():
+        data = os.read(sys.stdin.fileno(), 1024)
+        if not data:
+            # End of file, stop watching stdin
+            stop_listening_for_input(loop)
+            return
+        handle_input(data.decode(errors="ignore"))
+
+    try:
+        loop.add_reader(sys.stdin.fileno(), read_input)
+    except (AttributeError, NotImplementedError, OSError, ValueError):
+        pass
+
+
+def stop_listening_for_input(loop):
+    """ Stops watching stdin """
+    try:
+        loop.remove_reader(sys.stdin.fileno())
+    except (AttributeError, NotImplementedError, OSError, ValueError):
+        pass
+
+
+if __name__ == "__main__":
+    if Constants.HEURISTIC_PROFILE:
+        import Tuner
+        Tuner.load_profile(Constants.HEURISTIC_PROFILE)
+    if Constants.METRICS_ENABLED:
+        import Metrics
+        Metrics.start_from_config()
+    # Everything created at startup lives as long as the process, so leave it out of the collections to shorten them
+    gc.freeze()
+    asyncio.run(Runtime().run())
@@ -0,0 +1,188 @@
+""" Heuristic scoring of candidate placements. The numpy backend scores the candidate placements for a tetromino which
+complete no lines in one batch and returns exactly the scores calculate_board_score would """
+import threading
+import Constants
+import Placement
+
+# The numpy module, imported when the numpy backend is first used so the python backend doesn't wait for the import
+numpy = None
+# The scratch board state of each thread which scores placements, which a tetromino completing rows is added to
+scratch = threading.local()
+
+
+def weigh_features(complete_lines, empty_spaces_created, empty_spaces_nearby, average_column_height,
+                   total_height_variation, distance):
+    """ Combines the features of a board into a single score using the heuristic factors """
+    cumulative_score = complete_lines * Constants.COMPLETE_LINES_FACTOR
+    cumulative_score += empty_spaces_created * Constants.COVERED_EMPTY_SPACES_FACTOR
+    cumulative_score += empty_spaces_nearby * Constants.NEARBY_EMPTY_SPACES_FACTOR
+    cumulative_score += average_column_height * Constants.AVERAGE_COLUMN_HEIGHT_FACTOR
+    cumulative_score += total_height_variation * Constants.HEIGHT_VARIATION_FACTOR
+    if distance <= 1:
+        cumulative_score += distance * Constants.DISTANCE_FACTOR
+
+    return cumulative_score
+
+
+def calculate_board_score(board_state, tetromino, home_position):
+    """ Applies the heuristic to calculate a score for the board with the tetromino added in its current position. The
+    features are found from the changes the tetromino makes to the board state's cached features, only a tetromino
+    which completes a row requires them to be calculated again from a test state """
+    masks = tetromino.orientation.masks[tetromino.xpos]
+    complete_lines = count_complete_lines(board_state, tetromino)
+
+    features = None
+    if not complete_lines:
+        features = board_state.placement_features(tetromino)
+    if features is None:
+        # Add the tetromino to a test state and remove any completed lines
+        test_state = board_state.copy(get_scratch_state())
+        test_state.add(tetromino)
+        test_state.clear_rows(test_state.find_complete_rows(tetromino.ypos, tetromino.ypos + tetromino.height))
+        empty_spaces_created = count_created_spaces(test_state.rows, tetromino, ())
+        empty_spaces_nearby = sum(test_state.holes[tetromino.xpos:tetromino.xpos + tetromino.width])
+        height_sum = test_state.height_sum
+        total_height_variation = test_state.height_variation
+    else:
+        height_sum, total_height_variation, empty_spaces_nearby = features
+        empty_spaces_created = count_created_spaces(board_state.rows, tetromino, masks)
+
+    average_column_height = height_sum / Constants.BOARD_WIDTH
+    distance = abs(tetromino.xpos - home_position)
+
+    return weigh_features(complete_lines, empty_spaces_created, empty_spaces_nearby, average_column_height,
+                          total_height_variation, distance)
+
+
+def get_scratch_state():
+    """ Returns the current thread's scratch board state, creating it the first time """
+    if not hasattr(scratch, "state"):
+        scratch.state = Placement.BoardState()
+    return scratch.state
+
+
+def count_complete_lines(board_state, tetromino):
+    """ Counts the rows the tetromino would complete if it were added to the board in its current position """
+    rows = board_state.rows
+    return sum(1 for row, mask in enumerate(tetromino.orientation.masks[tetromino.xpos])
+               if board_state.is_complete(tetromino.ypos + row, rows[tetromino.ypos + row] | mask))
+
+
+def count_created_spaces(board, tetromino, masks):
+    """ Counts the occupied positions in the tetromino's columns, from its top row to the row beneath it, which have an
+    empty position directly beneath them. The masks of a tetromino not yet added to the board are ORed into its rows """
+    columns = ((1 << tetromino.width) - 1) << tetromino.xpos
+    last_row = min(tetromino.ypos + tetromino.height + 2, Constants.BOARD_HEIGHT)
+    window = [board[row] for row in range(tetromino.ypos, last_row)]
+    for row, mask in enumerate(masks):
+        window[row] |= mask
+    return sum(bin(window[row] & ~window[row + 1] & columns).count("1") for row in range(len(window) - 1))
+
+
+def import_numpy():
+    """ Imports numpy for the numpy backend if it hasn't been already """
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            raise ImportError("The numpy scoring backend requires numpy to be installed") from None
+        numpy = module
+
+
+def unpack_boards(boards, width):
+    """ Unpacks a list of boards with the given number of columns into an array of shape (boards, BOARD_HEIGHT, width)
+    holding a 1 for each occupied position """
+    row_bytes = (width + 7) // 8
+    packed = b"".join(row.to_bytes(row_bytes, "little") for board in boards for row in board)
+    bits = numpy.unpackbits(numpy.frombuffer(packed, dtype=numpy.uint8), bitorder="little")
+    return bits.reshape(len(boards), Constants.BOARD_HEIGHT, row_bytes * 8)[:, :, :width]
+
+
+def score_placement_batches(batches):
+    """ Scores several batches of candidate placements which complete no lines, such as the candidates for tetrominoes
+    in different windows of the same board. Each batch is a tuple of (board_state, tetromino, candidates,
+    home_position), where each candidate is a tuple of (xpos, ypos, rotation, width, height). The batches for board
+    states of the same width are scored together. Returns a list with the scores for each batch """
+    import_numpy()
+
+    batches_by_width = {}
+    for index, (board_state, _, _, _) in enumerate(batches):
+        batches_by_width.setdefault(board_state.width, []).append(index)
+    scores = [None] * len(batches)
+    for indexes in batches_by_width.values():
+        width_scores = score_same_width([batches[index] for index in indexes])
+        for index, batch_scores in zip(indexes, width_scores):
+            scores[index] = batch_scores
+    return scores
+
+
+def score_same_width(batches):
+    """ Scores batches of candidate placements for board states of the same width in a single pass """
+    width = batches[0][0].width
+    counts = numpy.array([len(candidates) for _, _, candidates, _ in batches])
+    candidates = [candidate for _, _, batch_candidates, _ in batches for candidate in batch_candidates]
+    count = len(candidates)
+    # Each board state is unpacked once and copied for each of its candidates, then the positions each candidate's
+    # tetromino occupies are added
+    occupied = unpack_boards([board_state.rows for board_state, _, _, _ in batches], width).astype(bool)
+    occupied = occupied[numpy.repeat(numpy.arange(len(batches)), counts)]
+    cell_candidates = []
+    cell_rows = []
+    cell_columns = []
+    for (_, tetromino, batch_candidates, _), first_candidate in zip(batches, numpy.cumsum(counts) - counts):
+        rotations = tetromino.shape.rotations
+        for candidate, (xpos, ypos, rotation, _, _) in enumerate(batch_candidates, first_candidate):
+            for column, row in rotations[rotation].cells:
+                cell_candidates.append(candidate)
+                cell_rows.append(ypos + row)
+                cell_columns.append(xpos + column)
+    occupied[cell_candidates, cell_rows, cell_columns] = True
+    # The rows of each board from the bottom up
+    occupied = occupied[:, ::-1, :]
+    xpos, ypos, _, tetromino_width, height = (numpy.array(values) for values in zip(*candidates))
+    home_positions = numpy.repeat([home_position for _, _, _, home_position in batches], counts)
+    scan_rows = Constants.BOARD_HEIGHT - 1 - numpy.arange(Constants.BOARD_HEIGHT)
+
+    # The column height is taken from the highest occupied position
+    any_occupied = occupied.any(axis=1)
+    last_occupied = Constants.BOARD_HEIGHT - 1 - numpy.argmax(occupied[:, ::-1, :], axis=1)
+    column_heights = numpy.where(any_occupied, Constants.BOARD_HEIGHT - scan_rows[last_occupied], 0)
+
+    # Every empty position beneath the highest occupied one in a column is covered
+    covered = numpy.where(any_occupied, last_occupied + 1 - occupied.sum(axis=1), 0)
+    columns = numpy.arange(width)[None, :]
+    nearby_columns = (columns >= xpos[:, None]) & (columns < (xpos + tetromino_width)[:, None])
+    empty_spaces_nearby = (covered * nearby_columns).sum(axis=1)
+
+    # An empty space is created beneath an occupied position in the tetromino's rows if the position below it is empty
+    newly_covered = occupied[:, 1:, :] & ~occupied[:, :-1, :]
+    rows = scan_rows[None, 1:]
+    nearby_rows = (rows >= ypos[:, None]) & (rows <= (ypos + height)[:, None])
+    empty_spaces_created = (newly_covered & nearby_rows[:, :, None] & nearby_columns[:, None, :]).sum(axis=(1, 2))
+
+    outside_features = [board_state.outside_features() for board_state, _, _, _ in batches]
+    if outside_features[0][2] is None:
+        # Wrap variation calculation to remove any preference/aversion for outermost columns
+        total_height_variation = numpy.abs(column_heights - numpy.roll(column_heights, 1, axis=1)).sum(axis=1)
+        column_height_sums = column_heights.sum(axis=1)
+    else:
+        # Include the variation between each window and the columns either side of it
+        outside_height_sum, outside_variation, left_top, right_top = (numpy.repeat(values, counts)
+                                                                      for values in zip(*outside_features))
+        column_heights = numpy.concatenate(((Constants.BOARD_HEIGHT - left_top)[:, None], column_heights,
+                                            (Constants.BOARD_HEIGHT - right_top)[:, None]), axis=1)
+        total_height_variation = numpy.abs(numpy.diff(column_heights, axis=1)).sum(axis=1) + outside_variation
+        column_height_sums = column_heights[:, 1:-1].sum(axis=1) + outside_height_sum
+    distances = numpy.abs(xpos - home_positions)
+
+    scores = [weigh_features(0, int(empty_spaces_created[i]), int(empty_spaces_nearby[i]),
+                             int(column_height_sums[i]) / Constants.BOARD_WIDTH, int(total_height_variation[i]),
+                             int(distances[i]))
+              for i in range(count)]
+    batch_scores = []
+    start = 0
+    for batch_count in counts:
+        batch_scores.append(scores[start:start + batch_count])
+        start += batch_count
+    return batch_scores
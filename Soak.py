@@ -0,0 +1,298 @@
+""" Soak test which plays seeded headless games back to back for hours, to find memory growth before the wall does.
+Memory allocated by the game's modules is traced with tracemalloc and attributed to the function which allocated it,
+garbage collector pauses are timed and the peak RSS is sampled, with a report written for every interval. The run fails
+if memory grows by more than a threshold once the games have warmed up. Run with python3 -m Soak """
+import argparse
+import ast
+import gc
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import Benchmark
+import Display
+import Engine
+import Metrics
+
+# The directory holding the game's modules, only memory allocated from files in it is attributed to functions
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# The number of ticks between samples of the RSS
+RSS_SAMPLE_TICKS = 100
+# The first and last line and the qualified name of every function in each source file, found when the file is first
+# seen in a snapshot
+function_ranges = {}
+
+
+class GcPauses(object):
+    """ Times every garbage collection through gc.callbacks. Only totals are kept for each generation, so the memory
+    used doesn't grow with the number of collections """
+    def __init__(self):
+        # The time the collection in progress started, None if no collection is in progress
+        self.start_time = None
+        # The number of collections, their total time and the longest in seconds, for each generation
+        self.counts = [0] * 3
+        self.total_times = [0.0] * 3
+        self.max_times = [0.0] * 3
+
+    def callback(self, phase, info):
+        if phase == "start":
+            self.start_time = time.perf_counter()
+        elif self.start_time is not None:
+            duration = time.perf_counter() - self.start_time
+            generation = info["generation"]
+            self.counts[generation] += 1
+            self.total_times[generation] += duration
+            self.max_times[generation] = max(self.max_times[generation], duration)
+            self.start_time = None
+
+    def install(self):
+        """ Starts timing collections """
+        gc.callbacks.append(self.callback)
+
+    def uninstall(self):
+        """ Stops timing collections """
+        gc.callbacks.remove(self.callback)
+
+    def take_report(self):
+        """ Returns the pauses of each generation since the last report with times in milliseconds, and starts over """
+        report = {f"generation_{generation}": {
+            "count": self.counts[generation],
+            "total_ms": self.total_times[generation] * 1000,
+            "max_ms": self.max_times[generation] * 1000,
+        } for generation in range(3)}
+        self.__init__()
+        return report
+
+
+def current_rss():
+    """ Returns the resident set size of the process in bytes, or the peak if the current size can't be read """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+def peak_rss():
+    """ Returns the peak resident set size of the process in bytes """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def function_at(filename, lineno):
+    """ Returns the name of the innermost function in the source file containing the line, qualified by its module and
+    class, or the module's name for module level code """
+    if filename not in function_ranges:
+        ranges = []
+
+        def visit(node, prefix):
+            for child in ast.iter_child_nodes(node):
+                if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    ranges.append((child.lineno, child.end_lineno, prefix + child.name))
+                    visit(child, prefix + child.name + ".")
+                elif isinstance(child, ast.ClassDef):
+                    visit(child, prefix + child.name + ".")
+                else:
+                    visit(child, prefix)
+
+        with open(filename) as source:
+            visit(ast.parse(source.read()), "")
+        function_ranges[filename] = ranges
+
+    module = os.path.splitext(os.path.basename(filename))[0]
+    innermost = None
+    for first_line, last_line, name in function_ranges[filename]:
+        if first_line <= lineno <= last_line and (innermost is None or first_line >= innermost[0]):
+            innermost = (first_line, name)
+    return f"{module}.{innermost[1]}" if innermost else module
+
+
+def take_snapshot():
+    """ Returns a tracemalloc snapshot of the memory allocated by the game's modules """
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(True, os.path.join(SOURCE_DIRECTORY, "*")),
+        tracemalloc.Filter(False, os.path.abspath(__file__)),
+    ])
+
+
+def growth_by_function(snapshot, baseline):
+    """ Returns the growth in the memory allocated by each function since the baseline snapshot, as a dictionary of the
+    function's name to the growth in bytes and in the number of blocks """
+    growth = {}
+    for statistic in snapshot.compare_to(baseline, "lineno"):
+        frame = statistic.traceback[0]
+        name = function_at(frame.filename, frame.lineno)
+        size, count = growth.get(name, (0, 0))
+        growth[name] = (size + statistic.size_diff, count + statistic.count_diff)
+    return growth
+
+
+def collect_untimed(pauses):
+    """ Runs a full collection, so garbage waiting to be collected isn't counted as growth, without recording its pause
+    """
+    pauses.uninstall()
+    gc.collect()
+    pauses.install()
+
+
+def run_soak(duration, interval, warmup, max_growth, seed=0, trace=True, top=10, sink=None, write_report=None):
+    """ Plays games for duration seconds, starting a new game with the next seed whenever one ends, and calls
+    write_report with a report every interval seconds. Growth is measured from the end of the warm up, in traced memory
+    or in RSS if trace is False, and the soak stops early if it exceeds max_growth bytes. Returns the reports """
+    pauses = GcPauses()
+    pauses.install()
+    if trace:
+        tracemalloc.start()
+    engine = Engine.Engine(sink, seed)
+    # Leave everything created at startup out of the collections, as the game's main does
+    gc.freeze()
+
+    start_time = time.monotonic()
+    interval_start = start_time
+    games = 0
+    ticks = 0
+    # The memory in use at the end of the warm up, and the snapshot of the game's allocations at the same time
+    baseline_memory = None
+    baseline = None
+    # The snapshot taken for the previous report, to find the growth during each interval
+    previous = None
+    # The number of ticks, the total and largest memory allocated at the peak of a tick and the peak RSS sampled, in
+    # the current interval
+    interval_ticks = 0
+    tick_peak_total = 0
+    tick_peak_max = 0
+    interval_peak_rss = current_rss()
+    # The total and longest time taken to begin a new game in the current interval, in seconds
+    restart_time_total = 0.0
+    restart_time_max = 0.0
+    interval_games = 0
+    reports = []
+    try:
+        while True:
+            current_time = time.monotonic()
+            if baseline_memory is None and current_time - start_time >= warmup:
+                collect_untimed(pauses)
+                baseline_memory = tracemalloc.get_traced_memory()[0] if trace else current_rss()
+                baseline = take_snapshot() if trace else None
+                previous = baseline
+
+            finished = current_time - start_time >= duration
+            if finished or current_time - interval_start >= interval:
+                latencies = engine.decision_latencies
+                report = {
+                    "elapsed_s": current_time - start_time,
+                    "games": games,
+                    "ticks": ticks,
+                    "interval_ticks": interval_ticks,
+                    "tick_time_ms": (current_time - interval_start) / max(interval_ticks, 1) * 1000,
+                    "p99_decision_latency_ms": Benchmark.percentile(latencies, 0.99) * 1000,
+                    "mean_restart_ms": restart_time_total / max(interval_games, 1) * 1000,
+                    "max_restart_ms": restart_time_max * 1000,
+                    "threads": threading.active_count(),
+                    "gc_pauses": pauses.take_report(),
+                    "interval_peak_rss_mb": interval_peak_rss / 2 ** 20,
+                    "process_peak_rss_mb": peak_rss() / 2 ** 20,
+                }
+                # The latencies grow with the length of a game and are only needed for the report
+                engine.decision_latencies = []
+                collect_untimed(pauses)
+                if trace:
+                    report["mean_tick_allocation_kb"] = tick_peak_total / max(interval_ticks, 1) / 1024
+                    report["max_tick_allocation_kb"] = tick_peak_max / 1024
+                    report["traced_mb"] = tracemalloc.get_traced_memory()[0] / 2 ** 20
+                memory = tracemalloc.get_traced_memory()[0] if trace else current_rss()
+                if baseline_memory is not None:
+                    report["growth_mb"] = (memory - baseline_memory) / 2 ** 20
+                if previous is not None:
+                    snapshot = take_snapshot()
+                    interval_growth = growth_by_function(snapshot, previous)
+                    total_growth = growth_by_function(snapshot, baseline)
+                    report["hot_paths"] = {f"{module}.{name}": dict(zip(("growth_bytes", "growth_blocks"),
+                                                                        total_growth.get(f"{module}.{name}", (0, 0))))
+                                           for module, name in Metrics.HOT_PATHS}
+                    report["top_growth"] = [{"function": name, "growth_bytes": size, "interval_growth_bytes":
+                                             interval_growth.get(name, (0, 0))[0], "growth_blocks": count}
+                                            for name, (size, count) in sorted(total_growth.items(),
+                                                                              key=lambda item: -item[1][0])[:top]]
+                    previous = snapshot
+                report["failed"] = baseline_memory is not None and memory - baseline_memory > max_growth
+                reports.append(report)
+                if write_report is not None:
+                    write_report(report)
+                if finished or report["failed"]:
+                    return reports
+
+                interval_start = current_time
+                interval_ticks = 0
+                tick_peak_total = 0
+                tick_peak_max = 0
+                interval_peak_rss = current_rss()
+                restart_time_total = 0.0
+                restart_time_max = 0.0
+                interval_games = 0
+
+            if trace:
+                tick_start_memory = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+            if not engine.step():
+                games += 1
+                interval_games += 1
+                restart_start = time.perf_counter()
+                engine.reset(seed + games)
+                restart_time = time.perf_counter() - restart_start
+                restart_time_total += restart_time
+                restart_time_max = max(restart_time_max, restart_time)
+            if trace:
+                tick_peak = tracemalloc.get_traced_memory()[1] - tick_start_memory
+                tick_peak_total += tick_peak
+                tick_peak_max = max(tick_peak_max, tick_peak)
+            ticks += 1
+            interval_ticks += 1
+            if ticks % RSS_SAMPLE_TICKS == 0:
+                interval_peak_rss = max(interval_peak_rss, current_rss())
+    finally:
+        pauses.uninstall()
+        gc.unfreeze()
+        if trace:
+            tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plays headless games for hours and reports memory growth")
+    parser.add_argument("--hours", type=float, default=24, help="how long to play for")
+    parser.add_argument("--interval", type=float, default=3600, help="the seconds between reports")
+    parser.add_argument("--warmup", type=float, default=600,
+                        help="the seconds played before the memory growth is measured")
+    parser.add_argument("--max-growth", type=float, default=16,
+                        help="the growth in megabytes after the warm up at which the soak fails")
+    parser.add_argument("--seed", type=int, default=0, help="the seed of the first game")
+    parser.add_argument("--display", choices=["null", "framebuffer", "png", "matrix"], default="null",
+                        help="the display backend frames are sent to")
+    parser.add_argument("--no-trace", action="store_true",
+                        help="don't trace allocations, measure the growth in RSS instead")
+    parser.add_argument("--top", type=int, default=10, help="the number of functions with the most growth reported")
+    parser.add_argument("--output", default="soak.jsonl", help="the file each report is appended to as a JSON line")
+    args = parser.parse_args()
+
+    def write_report(report):
+        with open(args.output, "a") as output:
+            output.write(json.dumps(report) + "\n")
+        growth = f", growth {report['growth_mb']:.2f}MB" if "growth_mb" in report else ""
+        longest_pause = max(generation["max_ms"] for generation in report["gc_pauses"].values())
+        print(f"{report['elapsed_s'] / 3600:.2f}h: {report['games']} games, {report['tick_time_ms']:.3f}ms per tick, "
+              f"peak RSS {report['interval_peak_rss_mb']:.1f}MB, longest GC pause {longest_pause:.2f}ms{growth}",
+              flush=True)
+
+    reports = run_soak(args.hours * 3600, args.interval, args.warmup, args.max_growth * 2 ** 20, args.seed,
+                       not args.no_trace, args.top, Display.create_sink(args.display), write_report)
+    if reports[-1]["failed"]:
+        print(f"Memory grew by {reports[-1]['growth_mb']:.2f}MB, more than {args.max_growth}MB", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
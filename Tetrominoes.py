@@ -1,29 +1,109 @@
 import Constants
+import threading
 import time
 from math import floor
 
 
+class Rotation(object):
+    """ Precomputed data for a single rotation of a tetromino shape. It is created once at import and never changed """
+    __slots__ = ("pattern", "width", "height", "cells", "profile", "masks")
+
+    def __init__(self, pattern):
+        # An array of binary numbers with a bit for each column and a 1 indicating the position is occupied. The array
+        # contains as many numbers as the rotated block has rows.
+        self.pattern = tuple(pattern)
+        self.width = max(row.bit_length() for row in self.pattern)
+        self.height = len(self.pattern)
+        # The (column, row) offsets of each occupied position
+        self.cells = tuple((column, row) for row in range(self.height) for column in range(self.width)
+                           if self.pattern[row] & (1 << column))
+        # The column offset and the offsets of the highest and lowest occupied rows for each column, used to find where
+        # the block lands
+        self.profile = tuple((column, min(row for cell_column, row in self.cells if cell_column == column),
+                              max(row for cell_column, row in self.cells if cell_column == column))
+                             for column in range(self.width))
+        # The pattern shifted into position for every x position at which the block fits on the board
+        self.masks = tuple(tuple(row << xpos for row in self.pattern)
+                           for xpos in range(Constants.BOARD_WIDTH - self.width + 1))
+
+
+class Shape(object):
+    """ The shared, immutable description of a type of tetromino """
+    __slots__ = ("id", "patterns", "rotations", "colour", "spawn_offset")
+
+    def __init__(self, tetromino_id, patterns, colour, spawn_offset):
+        # The number id of the type of tetromino
+        self.id = tetromino_id
+        # The patterns for each rotation of the block, incrementing rotation by 1 symbolises a 90 degree rotation
+        self.patterns = tuple(tuple(pattern) for pattern in patterns)
+        self.rotations = tuple(Rotation(pattern) for pattern in patterns)
+        self.colour = colour
+        # The offset from the middle of its game at which the block starts
+        self.spawn_offset = spawn_offset
+
+
 class Tetromino(object):
-    """ Base class from which all tetrominos inherit"""
-    def __init__(self, game):
+    """ Base class from which all tetrominos inherit. Each subclass sets its shape, instances only hold the state of a
+    single falling block """
+    __slots__ = ("game", "xpos", "ypos", "rotation", "last_drop_time", "goal", "plan", "landing_row", "holders")
+    shape = None
+
+    def __init__(self, game, holders=1):
+        self.reset(game, holders)
+
+    def reset(self, game, holders=1):
+        """ Puts the block at the top of its game with no goal, as a new block would be """
         # The number id of the game which the block was added to
         self.game = game
         # The x position of the block, starting in the middle of its respective game
-        self.xpos = floor((Constants.BOARD_WIDTH / Constants.NUM_GAMES) * (game + 0.5))
+        self.xpos = floor((Constants.BOARD_WIDTH / Constants.NUM_GAMES) * (game + 0.5)) + self.shape.spawn_offset
         # The y position of the block, starting at the top
         self.ypos = 0
         # The rotation of the block, incrementing rotation by 1 symbolises a 90 degree rotation
         self.rotation = 0
-        # The patterns for the block. A single pattern of a block is an array of binary numbers with a bit for each
-        # column and a 1 indicating the position is occupied. The array contains as many numbers as the block has rows.
-        self.patterns = []
         # Records the time at which the tetromino was last dropped a row, setting it to the current time avoids
         # having it drop as soon as the game starts
         self.last_drop_time = time.time()
-        # The goal x position decided by the heuristic, initialised to -1 and changed when decided
-        self.goal_xpos = -1
-        # The goal rotation decided by the heuristic, initialised to -1 and changed when decided
-        self.goal_rotation = -1
+        # The (xpos, rotation) decided by the heuristic, None until decided. It is set as a single tuple as the
+        # heuristic thread decides it while the game loop may be moving the block
+        self.goal = None
+        # The (xpos, rotation) the block moves to at each step towards its goal, planned when the goal is decided
+        self.plan = []
+        # The row the block comes to rest at if it falls from its current position, None until it is found and whenever
+        # the block moves sideways or rotates or the board changes
+        self.landing_row = None
+        # The number of holders which must release the block before it can be reused, see release
+        self.holders = holders
+
+    @property
+    def id(self):
+        """ The number id of the type of tetromino """
+        return self.shape.id
+
+    @property
+    def patterns(self):
+        """ The patterns for each rotation of the block """
+        return self.shape.patterns
+
+    @property
+    def colour(self):
+        """ The colour of the block as an RGB tuple """
+        return self.shape.colour
+
+    @property
+    def orientation(self):
+        """ The precomputed data for the block's current rotation """
+        return self.shape.rotations[self.rotation]
+
+    @property
+    def width(self):
+        """ The width of the block in its current rotation """
+        return self.shape.rotations[self.rotation].width
+
+    @property
+    def height(self):
+        """ The height of the block in its current rotation """
+        return self.shape.rotations[self.rotation].height
 
 
 class I(Tetromino):
@@ -33,14 +113,10 @@ class I(Tetromino):
     ----  --*-  ****  -*--
     ----  --*-  ----  -*--
     """
-    def __init__(self, game):
-        Tetromino.__init__(self, game)
-        self.patterns = [[0b1111],
-                         [0b1, 0b1, 0b1, 0b1]]
-        self.xpos -= 2
-        self.height = 1
-        self.width = 4
-        self.colour = (0, 120, 120)  # Cyan
+    __slots__ = ()
+    shape = Shape(0, [[0b1111],
+                      [0b1, 0b1, 0b1, 0b1]],
+                  (0, 120, 120), -2)  # Cyan
 
 
 class J(Tetromino):
@@ -49,16 +125,12 @@ class J(Tetromino):
     ***  --*  ***  -*-
     ---  --*  --*  **-
     """
-    def __init__(self, game):
-        Tetromino.__init__(self, game)
-        self.patterns = [[0b100, 0b111],
-                         [0b11, 0b10, 0b10],
-                         [0b111, 0b001],
-                         [0b01, 0b01, 0b11]]
-        self.xpos -= 1
-        self.height = 2
-        self.width = 3
-        self.colour = (0, 0, 120)  # Blue
+    __slots__ = ()
+    shape = Shape(1, [[0b100, 0b111],
+                      [0b11, 0b10, 0b10],
+                      [0b111, 0b001],
+                      [0b01, 0b01, 0b11]],
+                  (0, 0, 120), -1)  # Blue
 
 
 class L(Tetromino):
@@ -67,16 +139,12 @@ class L(Tetromino):
     ***  -*-  ***  -*-
     ---  -**  *--  -*-
     """
-    def __init__(self, game):
-        Tetromino.__init__(self, game)
-        self.patterns = [[0b001, 0b111],
-                         [0b10, 0b10, 0b11],
-                         [0b111, 0b100],
-                         [0b11, 0b01, 0b01]]
-        self.xpos -= 1
-        self.height = 2
-        self.width = 3
-        self.colour = (120, 80, 0)  # Orange
+    __slots__ = ()
+    shape = Shape(2, [[0b001, 0b111],
+                      [0b10, 0b10, 0b11],
+                      [0b111, 0b100],
+                      [0b11, 0b01, 0b01]],
+                  (120, 80, 0), -1)  # Orange
 
 
 class O(Tetromino):
@@ -84,12 +152,9 @@ class O(Tetromino):
     **
     **
     """
-    def __init__(self, game):
-        Tetromino.__init__(self, game)
-        self.patterns = [[0b11, 0b11]]
-        self.height = 2
-        self.width = 2
-        self.colour = (120, 120, 0)  # Yellow
+    __slots__ = ()
+    shape = Shape(3, [[0b11, 0b11]],
+                  (120, 120, 0), 0)  # Yellow
 
 
 class S(Tetromino):
@@ -98,14 +163,10 @@ class S(Tetromino):
     **-  -**  -**  **-
     ---  --*  **-  -*-
     """
-    def __init__(self, game):
-        Tetromino.__init__(self, game)
-        self.patterns = [[0b011, 0b110],
-                         [0b10, 0b11, 0b01]]
-        self.xpos -= 1
-        self.height = 2
-        self.width = 3
-        self.colour = (0, 120, 0)  # Green
+    __slots__ = ()
+    shape = Shape(4, [[0b011, 0b110],
+                      [0b10, 0b11, 0b01]],
+                  (0, 120, 0), -1)  # Green
 
 
 class T(Tetromino):
@@ -114,16 +175,12 @@ class T(Tetromino):
     ***  -**  ***  **-
     ---  -*-  -*-  -*-
     """
-    def __init__(self, game):
-        Tetromino.__init__(self, game)
-        self.patterns = [[0b010, 0b111],
-                         [0b10, 0b11, 0b10],
-                         [0b111, 0b010],
-                         [0b01, 0b11, 0b01]]
-        self.xpos -= 1
-        self.height = 2
-        self.width = 3
-        self.colour = (80, 0, 120)  # Purple
+    __slots__ = ()
+    shape = Shape(5, [[0b010, 0b111],
+                      [0b10, 0b11, 0b10],
+                      [0b111, 0b010],
+                      [0b01, 0b11, 0b01]],
+                  (80, 0, 120), -1)  # Purple
 
 
 class Z(Tetromino):
@@ -132,11 +189,52 @@ class Z(Tetromino):
     -**  -**  **-  **-
     ---  -*-  -**  *--
     """
-    def __init__(self, game):
-        Tetromino.__init__(self, game)
-        self.patterns = [[0b110, 0b011],
-                         [0b01, 0b11, 0b10]]
-        self.xpos -= 1
-        self.height = 2
-        self.width = 3
-        self.colour = (120, 0, 0)  # Red
+    __slots__ = ()
+    shape = Shape(6, [[0b110, 0b011],
+                      [0b01, 0b11, 0b10]],
+                  (120, 0, 0), -1)  # Red
+
+
+# The tetromino classes indexed by their id
+tetromino_classes = [I, J, L, O, S, T, Z]
+# The registry of shapes indexed by their id, built once at import
+shapes = [tetromino_class.shape for tetromino_class in tetromino_classes]
+# The released instances of each type of tetromino indexed by id, reused by acquire so a long running game doesn't
+# keep creating new ones
+pool = [[] for _ in tetromino_classes]
+# Guards the holders of every tetromino, as tetrominoes are released from both the game loop and the heuristic thread
+holders_lock = threading.Lock()
+
+
+def acquire(tetromino_id, game, holders=1):
+    """ Returns a tetromino with the given id at the top of the game, reusing a released instance if there is one. It
+    returns to the pool once each of its holders has released it """
+    try:
+        tetromino = pool[tetromino_id].pop()
+    except IndexError:
+        return tetromino_classes[tetromino_id](game, holders)
+    tetromino.reset(game, holders)
+    return tetromino
+
+
+def acquire_copy(tetromino):
+    """ Returns a tetromino in the same state as the given one with a single holder, used as scratch by the heuristic in
+    place of copy.copy """
+    try:
+        scratch = pool[tetromino.shape.id].pop()
+    except IndexError:
+        scratch = object.__new__(type(tetromino))
+    for name in Tetromino.__slots__:
+        setattr(scratch, name, getattr(tetromino, name))
+    scratch.holders = 1
+    return scratch
+
+
+def release(tetromino):
+    """ Releases one hold on the tetromino. Once every holder has released it the tetromino is returned to the pool, so
+    it must not be used by the caller afterwards """
+    with holders_lock:
+        tetromino.holders -= 1
+        if tetromino.holders:
+            return
+    pool[tetromino.shape.id].append(tetromino)
@@ -0,0 +1,181 @@
+""" Offline tuner for the heuristic factors. Seeded headless games are played across a process pool and the factors are
+searched with the cross entropy method. Run with python3 -m Tuner, the best factors are written as a JSON profile which
+can be loaded by setting HEURISTIC_PROFILE in Constants or passing --profile to the benchmark """
+import argparse
+import concurrent.futures
+import json
+import random
+import Benchmark
+import Constants
+import Engine
+import Game
+
+# The names of the heuristic factors in Constants which are tuned
+FACTOR_NAMES = [
+    "COMPLETE_LINES_FACTOR",
+    "COVERED_EMPTY_SPACES_FACTOR",
+    "NEARBY_EMPTY_SPACES_FACTOR",
+    "AVERAGE_COLUMN_HEIGHT_FACTOR",
+    "HEIGHT_VARIATION_FACTOR",
+    "DISTANCE_FACTOR",
+]
+# The smallest standard deviation a factor is sampled with, which stops the search collapsing onto a single value
+MIN_DEVIATION = 0.01
+# The fraction of the new distribution taken from the elite candidates each generation, the rest is kept from the old
+SMOOTHING = 0.7
+
+# The engine used by a worker process, created by the first game the process plays
+engine = None
+
+
+def get_factors():
+    """ Returns the current heuristic factors from Constants """
+    return {name: getattr(Constants, name) for name in FACTOR_NAMES}
+
+
+def set_factors(factors):
+    """ Sets the heuristic factors in Constants """
+    for name, value in factors.items():
+        setattr(Constants, name, value)
+
+
+def load_profile(path):
+    """ Sets the heuristic factors in Constants from a profile written by the tuner """
+    with open(path) as profile:
+        set_factors(json.load(profile)["factors"])
+
+
+def play_game(factors, seed, max_ticks):
+    """ Worker process entry point which plays a seeded game with the given factors. Returns the lines cleared and the
+    tetrominoes placed """
+    global engine
+    if engine is None:
+        engine = Engine.Engine()
+    set_factors(factors)
+    engine.reset(seed)
+    engine.run(max_ticks)
+    return Game.cleared_lines, Game.placed_tetrominoes
+
+
+def evaluate(pool, population, seeds, max_ticks):
+    """ Plays every candidate in the population on each seed across the pool. Returns the lines cleared and tetrominoes
+    placed in each game for each candidate """
+    futures = [[pool.submit(play_game, factors, seed, max_ticks) for seed in seeds] for factors in population]
+    return [[future.result() for future in candidate_futures] for candidate_futures in futures]
+
+
+def score(games):
+    """ Scores the results of a candidate's games as the mean lines cleared, with ties broken by the mean tetrominoes
+    placed as short games often end before any lines are cleared """
+    return (sum(lines for lines, _ in games) / len(games),
+            sum(tetrominoes for _, tetrominoes in games) / len(games))
+
+
+def race(pool, population, seed_batches, max_ticks):
+    """ Evaluates the population in batches of seeds. After each batch the candidates scoring below the median are
+    dropped, so poor candidates are terminated early and only the best play every batch. Returns a score for each
+    candidate which ranks dropped candidates below every candidate which played more batches """
+    results = [[] for _ in population]
+    remaining = list(range(len(population)))
+    for batch, seeds in enumerate(seed_batches):
+        batch_results = evaluate(pool, [population[candidate] for candidate in remaining], seeds, max_ticks)
+        for candidate, games in zip(remaining, batch_results):
+            results[candidate] += games
+        if batch < len(seed_batches) - 1:
+            remaining.sort(key=lambda candidate: score(results[candidate]), reverse=True)
+            remaining = remaining[:max((len(remaining) + 1) // 2, 1)]
+    return [(len(games),) + score(games) for games in results]
+
+
+def sample(generator, means, deviations):
+    """ Samples a candidate from the normal distribution of each factor """
+    return {name: generator.gauss(means[name], deviations[name]) for name in FACTOR_NAMES}
+
+
+def tune(generations, population_size, elite_fraction, games, batches, max_ticks, processes, seed):
+    """ Searches for the factors clearing the most lines with the cross entropy method, starting from the factors in
+    Constants. Each generation samples a population, races it on new seeds and refits the distribution to the elite
+    candidates. Returns the profile of the better of the final distribution's mean and the baseline factors, scored on
+    the same held out seeds. The baseline is kept on a tie, so a profile only replaces it when it clears more lines """
+    generator = random.Random(seed)
+    baseline = get_factors()
+    means = dict(baseline)
+    deviations = {name: max(abs(value) / 2, MIN_DEVIATION) for name, value in baseline.items()}
+    elite_count = max(int(population_size * elite_fraction), 1)
+    games_per_batch = max(games // batches, 1)
+    next_seed = seed
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        for generation in range(generations):
+            population = [sample(generator, means, deviations) for _ in range(population_size)]
+            seed_batches = []
+            for _ in range(batches):
+                seed_batches.append(list(range(next_seed, next_seed + games_per_batch)))
+                next_seed += games_per_batch
+            scores = race(pool, population, seed_batches, max_ticks)
+            ranked = sorted(range(population_size), key=lambda candidate: scores[candidate], reverse=True)
+            elites = [population[candidate] for candidate in ranked[:elite_count]]
+
+            for name in FACTOR_NAMES:
+                values = [elite[name] for elite in elites]
+                mean = sum(values) / len(values)
+                deviation = (sum((value - mean) ** 2 for value in values) / len(values)) ** 0.5
+                means[name] = SMOOTHING * mean + (1 - SMOOTHING) * means[name]
+                deviations[name] = max(SMOOTHING * deviation + (1 - SMOOTHING) * deviations[name], MIN_DEVIATION)
+            print(f"Generation {generation + 1}/{generations}: best {scores[ranked[0]][1]:.1f} lines, "
+                  f"elite mean {sum(scores[candidate][1] for candidate in ranked[:elite_count]) / elite_count:.1f} "
+                  f"lines", flush=True)
+
+        # Compare the tuned factors with the baseline on seeds neither was tuned on
+        validation_seeds = list(range(next_seed, next_seed + games))
+        tuned_games, baseline_games = evaluate(pool, [means, baseline], validation_seeds, max_ticks)
+
+    tuned_score = score(tuned_games)
+    baseline_score = score(baseline_games)
+    return {
+        "commit": Benchmark.get_commit(),
+        "factors": means if tuned_score > baseline_score else baseline,
+        "score": max(tuned_score, baseline_score)[0],
+        "baseline_score": baseline_score[0],
+        "config": {
+            "generations": generations,
+            "population": population_size,
+            "elite_fraction": elite_fraction,
+            "games": games,
+            "batches": batches,
+            "max_ticks": max_ticks,
+            "seed": seed,
+            "num_games": Constants.NUM_GAMES,
+            "board_width": Constants.BOARD_WIDTH,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tunes the heuristic factors by playing seeded headless games")
+    parser.add_argument("--generations", type=int, default=20, help="the number of generations to search")
+    parser.add_argument("--population", type=int, default=24, help="the number of candidates in each generation")
+    parser.add_argument("--elite", type=float, default=0.25, help="the fraction of candidates the search refits to")
+    parser.add_argument("--games", type=int, default=8, help="the number of games each surviving candidate plays")
+    parser.add_argument("--batches", type=int, default=2,
+                        help="the number of batches games are played in, halving the candidates after each")
+    parser.add_argument("--max-ticks", type=int, default=5000, help="the tick limit at which each game is ended")
+    parser.add_argument("--processes", type=int, default=None, help="the number of worker processes, one per core by "
+                                                                     "default")
+    parser.add_argument("--seed", type=int, default=0, help="the seed of the search and its first game")
+    parser.add_argument("--profile", help="a profile to start the search from instead of the factors in Constants")
+    parser.add_argument("--output", default="profile.json", help="the file the best factors are written to")
+    args = parser.parse_args()
+
+    if args.profile:
+        load_profile(args.profile)
+    profile = tune(args.generations, args.population, args.elite, args.games, args.batches, args.max_ticks,
+                   args.processes, args.seed)
+    with open(args.output, "w") as output:
+        json.dump(profile, output, indent=2)
+    print(f"Wrote factors clearing {profile['score']:.1f} lines per game to {args.output} "
+          f"(baseline {profile['baseline_score']:.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+""" Regression checks for the optimisations which must leave the heuristic's choices unchanged. Plays seeded headless
+games and checks at every tick that the numpy and python scoring backends give identical scores, that the incrementally
+updated board state matches one rebuilt from its rows and that scoring within a game's window matches scoring the whole
+board. Run with python3 -m Verify, it exits with an error on the first mismatch """
+import argparse
+import random
+import sys
+import Constants
+import Engine
+import Game
+import Heuristic
+import Placement
+import Scoring
+import Tetrominoes
+
+
+def state_features(state):
+    """ Returns the rows of the board state and every feature kept up to date as it changes """
+    return state.rows, state.tops, state.holes, state.height_sum, state.height_variation
+
+
+def check_incremental(state):
+    """ Returns a description of the mismatch if the board state's features differ from those of a state rebuilt from
+    its rows, otherwise None """
+    rebuilt = Placement.BoardState(list(state.rows))
+    for name, value, expected in zip(("rows", "tops", "holes", "height_sum", "height_variation"),
+                                     state_features(state), state_features(rebuilt)):
+        if value != expected:
+            return f"incremental {name} {value} differs from the rebuilt {expected}"
+    return None
+
+
+def check_backends(state, tetromino):
+    """ Returns a description of the mismatch if the numpy and python backends score the tetromino's candidates on the
+    board state differently, otherwise None """
+    backend = Constants.SCORING_BACKEND
+    scores = {}
+    try:
+        for name in ("python", "numpy"):
+            Constants.SCORING_BACKEND = name
+            scores[name] = Heuristic.score_candidates(state, tetromino, Constants.BOARD_WIDTH)
+    finally:
+        Constants.SCORING_BACKEND = backend
+    if len(scores["python"]) != len(scores["numpy"]):
+        return f"python backend has {len(scores['python'])} candidates but numpy has {len(scores['numpy'])}"
+    for python_candidate, numpy_candidate in zip(scores["python"], scores["numpy"]):
+        if python_candidate != numpy_candidate:
+            return f"python backend scored {python_candidate} but numpy scored {numpy_candidate}"
+    return None
+
+
+def check_window(state, tetromino):
+    """ Returns a description of the mismatch if scoring the tetromino's candidates within its game's window differs
+    from scoring them on the whole board state, otherwise None """
+    first_column, last_column = Heuristic.game_window(tetromino.game)
+    placement_columns = Heuristic.game_columns(tetromino.game)[1]
+    # Only the candidates within the window are compared
+    whole = [candidate for candidate in Heuristic.score_candidates(state, tetromino, placement_columns)
+             if candidate[1] >= first_column]
+    local_tetromino = Tetrominoes.acquire_copy(tetromino)
+    local_tetromino.xpos -= first_column
+    windowed = [(board_score, xpos + first_column, rotation, ypos) for board_score, xpos, rotation, ypos in
+                Heuristic.score_candidates(state.window(first_column, last_column), local_tetromino,
+                                           placement_columns - first_column)]
+    Tetrominoes.release(local_tetromino)
+    if len(whole) != len(windowed):
+        return f"window has {len(windowed)} candidates but the whole board has {len(whole)}"
+    for whole_candidate, window_candidate in zip(whole, windowed):
+        if whole_candidate != window_candidate:
+            return f"whole board scored {whole_candidate} but the window scored {window_candidate}"
+    return None
+
+
+def verify(games, seed, max_ticks, backends=True):
+    """ Plays games from consecutive seeds for up to max_ticks each, running every check on the decided board after
+    each tick with a random tetromino in a random game. The backends are only compared if backends is True. Returns a
+    tuple of the number of ticks checked and a description of the first mismatch, or None if every check passed """
+    generator = random.Random(seed)
+    engine = Engine.Engine(seed=seed)
+    ticks = 0
+    for game_seed in range(seed, seed + games):
+        engine.reset(game_seed)
+        while engine.ticks < max_ticks and engine.step():
+            ticks += 1
+            tetromino = Tetrominoes.acquire(generator.randrange(len(Tetrominoes.tetromino_classes)),
+                                            generator.randrange(Constants.NUM_GAMES))
+            tetromino.rotation = generator.randrange(len(tetromino.patterns))
+            mismatch = check_incremental(Game.board_state)
+            if backends:
+                mismatch = mismatch or check_backends(Game.board_state, tetromino)
+            mismatch = mismatch or check_window(Game.board_state, tetromino)
+            Tetrominoes.release(tetromino)
+            if mismatch is not None:
+                return ticks, f"Seed {game_seed} tick {engine.ticks}: {mismatch}"
+    return ticks, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the heuristic's optimisations against their reference")
+    parser.add_argument("--games", type=int, default=3, help="the number of games to play")
+    parser.add_argument("--seed", type=int, default=0, help="the seed of the first game")
+    parser.add_argument("--max-ticks", type=int, default=1000, help="the tick limit for each game")
+    args = parser.parse_args()
+
+    try:
+        Scoring.import_numpy()
+        backends = True
+    except ImportError:
+        print("numpy is not installed, the scoring backends are not compared", file=sys.stderr)
+        backends = False
+    ticks, mismatch = verify(args.games, args.seed, args.max_ticks, backends)
+    if mismatch is not None:
+        print(mismatch, file=sys.stderr)
+        sys.exit(1)
+    print(f"Checked {ticks} ticks over {args.games} games, every check passed")
+
+
+if __name__ == "__main__":
+    main()